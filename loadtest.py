@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+# Replays captured webhook updates against passenger_wsgi.application at
+# increasing rates, to find how many updates per second a process sustains.
+#
+# Capture updates in production by setting capture_path (and capture_salt)
+# in a bot's config section. Then run this against a test config whose bots
+# use a local redis and have telegram_base_url pointed at the stub API server
+# this script starts, e.g.
+#
+#   telegram_base_url=http://127.0.0.1:8081/bot
+#
+#   python3 loadtest.py -c loadtest.ini -u captured_updates.jsonl \
+#       --rates 25,50,100,200,400 --duration 20
+#
+# For each rate it reports the update rate actually handled, latency from
+# POST to the dispatcher finishing the update, and how each bot's
+# update_queue grew. The first rate where the handled rate falls behind or
+# the queues keep growing is where the process saturates.
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Event, Lock
+import argparse
+import configparser
+import json
+import os
+import sys
+import time
+
+# Canned results for the API methods the bot cares about the answer to.
+# Everything else just gets "true".
+STUB_RESULTS = {
+    "getMe": {"id": 1, "first_name": "Load Test Bot", "username": "loadtest_bot"},
+    "getWebhookInfo": {"url": "", "has_custom_certificate": False,
+                       "pending_update_count": 0},
+    "getChatMembersCount": 10,
+    "getChatMember": {"user": {"id": 1, "first_name": "Load Test Bot"},
+                      "status": "member"},
+}
+
+
+class StubTelegramHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        method = self.path.rstrip("/").split("/")[-1]
+        if method in STUB_RESULTS:
+            result = STUB_RESULTS[method]
+        elif method.startswith("send"):
+            result = {"message_id": 1, "date": int(time.time()),
+                      "chat": {"id": 1, "type": "private"}}
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubTelegramServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LatencyRecorder(object):
+    # Wraps a dispatcher's processUpdate to time each update from when it was
+    # posted to when its handlers finished.
+    def __init__(self):
+        self.lock = Lock()
+        self.posted = {}
+        self.latencies = []
+        self.completed = []
+
+    def post(self, update_id):
+        with self.lock:
+            self.posted[update_id] = time.monotonic()
+
+    def wrap(self, dispatcher):
+        process_update = dispatcher.processUpdate
+
+        def timed_process_update(update):
+            try:
+                process_update(update)
+            finally:
+                done = time.monotonic()
+                update_id = getattr(update, "update_id", None)
+                with self.lock:
+                    posted = self.posted.pop(update_id, None)
+                    if posted is not None:
+                        self.latencies.append(done - posted)
+                        self.completed.append(done)
+        dispatcher.processUpdate = timed_process_update
+
+    def pending(self):
+        with self.lock:
+            return len(self.posted)
+
+    def reset(self):
+        with self.lock:
+            self.posted = {}
+            self.latencies = []
+            self.completed = []
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def load_capture(path, tokens):
+    updates = []
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry["bot"] not in tokens:
+                continue
+            updates.append((tokens[entry["bot"]], entry["update"]))
+    return updates
+
+
+def run_step(client, bots, recorder, updates, rate, duration, drain_timeout,
+             next_update_id):
+    recorder.reset()
+    queue_samples = dict((token, []) for token in bots)
+    stop_sampling = Event()
+
+    def sample_queues():
+        while not stop_sampling.wait(0.1):
+            for (token, bot) in bots.items():
+                queue_samples[token].append(bot.update_queue.qsize())
+    sampler = Thread(target=sample_queues, daemon=True)
+    sampler.start()
+
+    total = int(rate * duration)
+    start = time.monotonic()
+    for i in range(total):
+        due = start + i / float(rate)
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        (token, update) = updates[i % len(updates)]
+        # Fresh update ids so repeats of the capture can be told apart
+        update = dict(update)
+        update["update_id"] = next_update_id
+        recorder.post(next_update_id)
+        next_update_id += 1
+        client.post("/telegram/{0}".format(token), data=json.dumps(update),
+                    content_type="application/json")
+    post_time = time.monotonic() - start
+
+    drain_start = time.monotonic()
+    while recorder.pending() > 0 and time.monotonic() - drain_start < drain_timeout:
+        time.sleep(0.05)
+    stop_sampling.set()
+    sampler.join()
+
+    completed = len(recorder.latencies)
+    elapsed = (max(recorder.completed) - start) if recorder.completed else post_time
+    result = {"rate": rate,
+              "posted": total,
+              "post_rate": total / post_time if post_time > 0 else 0.0,
+              "completed": completed,
+              "handled_rate": completed / elapsed if elapsed > 0 else 0.0,
+              "p50": percentile(recorder.latencies, 50),
+              "p95": percentile(recorder.latencies, 95),
+              "p99": percentile(recorder.latencies, 99),
+              "unfinished": recorder.pending()}
+    # Each bot's queue growth per second over the posting phase. Anything
+    # clearly positive means updates arrive faster than that bot's
+    # dispatcher handles them.
+    samples_during_post = int(post_time / 0.1)
+    result["queues"] = {}
+    for (token, s) in queue_samples.items():
+        growth = 0.0
+        posted = s[:samples_during_post]
+        if len(posted) > 1:
+            growth = (posted[-1] - posted[0]) / (len(posted) * 0.1)
+        result["queues"][token] = {"max_queue": max(s or [0]),
+                                   "queue_growth": growth}
+    # Totals across bots, for the saturation check
+    result["max_queue"] = max(q["max_queue"] for q in result["queues"].values())
+    growth = sum(q["queue_growth"] for q in result["queues"].values())
+    result["queue_growth"] = growth
+    result["saturated"] = (result["unfinished"] > 0 or
+                           result["handled_rate"] < rate * 0.95 or
+                           growth > rate * 0.05)
+    return (result, next_update_id)
+
+
+def parse_cli_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", dest="config", required=True,
+                        help="Test configuration file, with local redis and stub telegram_base_url")
+    parser.add_argument("-u", "--updates", dest="updates", required=True,
+                        help="Captured updates file")
+    parser.add_argument("--rates", dest="rates", default="25,50,100,200,400",
+                        help="Comma separated updates per second to try, in order")
+    parser.add_argument("--duration", dest="duration", type=float, default=20,
+                        help="Seconds to post at each rate")
+    parser.add_argument("--drain-timeout", dest="drain_timeout", type=float,
+                        default=30,
+                        help="Seconds to wait for queues to empty after each rate")
+    parser.add_argument("--stub-port", dest="stub_port", type=int,
+                        default=8081,
+                        help="Port for the stub telegram API server")
+    parser.add_argument("--keep-going", dest="keep_going",
+                        action="store_true",
+                        help="Keep trying higher rates after saturating")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli_arguments()
+    rates = [float(r) for r in args.rates.split(",")]
+
+    stub = StubTelegramServer(("127.0.0.1", args.stub_port),
+                              StubTelegramHandler)
+    Thread(target=stub.serve_forever, daemon=True).start()
+
+    os.environ["NPBOT_CONFIG"] = args.config
+    os.environ["NPBOT_NO_REEXEC"] = "1"
+    sys.path.append(os.getcwd())
+    import passenger_wsgi
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    tokens = dict((name, config[name]["token"]) for name in config.sections()
+                  if config[name]["token"] in passenger_wsgi.bots)
+    for bot in passenger_wsgi.bots.values():
+        if bot.publisher is not None:
+            print("Bot {0} is distributed, only in-process dispatch is measured.".format(bot.config.name))
+            sys.exit(1)
+    updates = load_capture(args.updates, tokens)
+    if not updates:
+        print("No captured updates for the bots in {0}!".format(args.config))
+        sys.exit(1)
+
+    recorder = LatencyRecorder()
+    for bot in passenger_wsgi.bots.values():
+        recorder.wrap(bot.dispatcher)
+    client = passenger_wsgi.application.test_client()
+
+    print("Replaying {0} captured updates across {1} bots".format(len(updates),
+                                                                  len(tokens)))
+    print("{0:>8} {1:>9} {2:>9} {3:>8} {4:>8} {5:>8} {6:>9} {7:>10}".format("rate", "posted/s",
+                                                                            "handled/s", "p50 ms",
+                                                                            "p95 ms", "p99 ms",
+                                                                            "max queue", "queue/s"))
+    next_update_id = 1
+    saturation = None
+    for rate in rates:
+        (result, next_update_id) = run_step(client, passenger_wsgi.bots,
+                                            recorder, updates, rate,
+                                            args.duration, args.drain_timeout,
+                                            next_update_id)
+        print("{0:8.0f} {1:9.1f} {2:9.1f} {3:8.1f} {4:8.1f} {5:8.1f} {6:9d} {7:10.2f}{8}".format(result["rate"],
+                                                                                                  result["post_rate"],
+                                                                                                  result["handled_rate"],
+                                                                                                  result["p50"] * 1000,
+                                                                                                  result["p95"] * 1000,
+                                                                                                  result["p99"] * 1000,
+                                                                                                  result["max_queue"],
+                                                                                                  result["queue_growth"],
+                                                                                                  " SATURATED" if result["saturated"] else ""))
+        for (name, token) in sorted(tokens.items()):
+            queue = result["queues"][token]
+            print("{0:>8} {1:>46} {2:9d} {3:10.2f}".format("", name,
+                                                           queue["max_queue"],
+                                                           queue["queue_growth"]))
+        if result["saturated"] and saturation is None:
+            saturation = rate
+            if not args.keep_going:
+                break
+
+    if saturation is None:
+        print("Did not saturate, try higher rates.")
+    else:
+        print("Saturated at {0:.0f} updates/s.".format(saturation))
+
+    for bot in passenger_wsgi.bots.values():
+        bot.dispatcher.stop()
+        bot.shutdown()
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
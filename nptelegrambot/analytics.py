@@ -0,0 +1,240 @@
+from .base import NPModuleBase
+from collections import defaultdict, Counter
+from threading import Thread, Event, Lock
+import datetime
+import json
+import io
+
+# Most user id -> bitmap offset mappings kept in memory before starting over
+MAX_CACHED_OFFSETS = 100000
+
+
+class ActivityTracker(NPModuleBase):
+    def __init__(self, store, keys, flush_interval=10, retention_days=90):
+        super().__init__(__name__)
+        self.store = store
+        self.keys = keys
+        self.flush_interval = flush_interval
+        self.retention = datetime.timedelta(days=retention_days)
+        # Updates are recorded into local buffers and written out by a
+        # background thread, so the dispatcher never waits on redis for
+        # analytics.
+        self.lock = Lock()
+        self.unique = defaultdict(set)
+        self.bits = defaultdict(set)
+        self.counters = defaultdict(Counter)
+        self.expiries = {}
+        # Day bitmaps are indexed by a dense per-bot offset instead of the
+        # user id, since redis sizes a bitmap by its highest offset and
+        # telegram ids run past 2^32.
+        self.offsets = {}
+        # Flushes come from the flush thread and the stats commands
+        self.flush_lock = Lock()
+        self.stop_event = Event()
+        self.thread = None
+
+    @staticmethod
+    def today():
+        return datetime.datetime.utcnow().date()
+
+    @staticmethod
+    def day_id(day):
+        return day.strftime("%Y%m%d")
+
+    @staticmethod
+    def month_id(day):
+        return day.strftime("%Y%m")
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self.flush_loop, name='analytics',
+                             daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join(self.flush_interval)
+        self.thread = None
+        # Write anything that came in after the last loop pass
+        self.flush()
+
+    def flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def record_update(self, update):
+        if update.message is not None:
+            msg = update.message
+        elif update.edited_message is not None:
+            msg = update.edited_message
+        else:
+            return
+        if msg.from_user is None:
+            return
+        user_id = msg.from_user.id
+        day = self.today()
+        day_key = self.day_id(day)
+        expire = day + self.retention
+        with self.lock:
+            self.add_unique(self.keys.daily_users(day_key), user_id, expire)
+            # Monthly counters outlive the daily ones by a year
+            self.add_unique(self.keys.monthly_users(self.month_id(day)),
+                            user_id, expire + datetime.timedelta(days=366))
+            if msg.chat.id < 0:
+                self.add_unique(self.keys.daily_chat_senders(msg.chat.id,
+                                                             day_key),
+                                user_id, expire)
+            bitmap = self.keys.daily_user_bitmap(day_key)
+            self.bits[bitmap].add(user_id)
+            self.expiries[bitmap] = expire
+
+    def record_command(self, command):
+        day = self.today()
+        with self.lock:
+            key = self.keys.daily_commands(self.day_id(day))
+            self.counters[key][command] += 1
+            self.expiries[key] = day + self.retention
+
+    # Must be called with the lock held
+    def add_unique(self, key, member, expire):
+        self.unique[key].add(member)
+        self.expiries[key] = expire
+
+    # Maps user ids to their bitmap offsets, handing out new offsets from a
+    # counter for users we haven't seen before. Only called from flush, off
+    # the dispatcher threads, with the flush lock held.
+    def user_offsets(self, user_ids):
+        offsets = dict((u, self.offsets[u]) for u in user_ids
+                       if u in self.offsets)
+        missing = [u for u in user_ids if u not in offsets]
+        if missing:
+            index_key = self.keys.stats_user_index()
+            for (user_id, offset) in zip(missing,
+                                         self.store.hmget(index_key, missing)):
+                if offset is not None:
+                    offsets[user_id] = int(offset)
+            new = [u for u in missing if u not in offsets]
+            if new:
+                last = self.store.incrby(self.keys.stats_user_counter(),
+                                         len(new))
+                candidates = list(range(last - len(new), last))
+                pipe = self.store.pipeline(transaction=False)
+                for (user_id, offset) in zip(new, candidates):
+                    pipe.hsetnx(index_key, user_id, offset)
+                lost = []
+                for (user_id, offset, added) in zip(new, candidates,
+                                                    pipe.execute()):
+                    if added:
+                        offsets[user_id] = offset
+                    else:
+                        lost.append(user_id)
+                # Another process mapped these first, use its offsets. The
+                # offsets we reserved just go unused.
+                if lost:
+                    for (user_id, offset) in zip(lost,
+                                                 self.store.hmget(index_key, lost)):
+                        offsets[user_id] = int(offset)
+            if len(self.offsets) > MAX_CACHED_OFFSETS:
+                self.offsets = {}
+            self.offsets.update((u, offsets[u]) for u in missing)
+        return offsets
+
+    def flush(self):
+        with self.flush_lock:
+            self.flush_buffers()
+
+    def flush_buffers(self):
+        with self.lock:
+            if not (self.unique or self.bits or self.counters):
+                return
+            (unique, bits, counters, expiries) = (self.unique, self.bits,
+                                                  self.counters, self.expiries)
+            self.unique = defaultdict(set)
+            self.bits = defaultdict(set)
+            self.counters = defaultdict(Counter)
+            self.expiries = {}
+        try:
+            offsets = self.user_offsets(list(set().union(*bits.values())))
+            pipe = self.store.pipeline(transaction=False)
+            for (key, members) in unique.items():
+                pipe.pfadd(key, *members)
+            for (key, user_ids) in bits.items():
+                for user_id in user_ids:
+                    pipe.setbit(key, offsets[user_id], 1)
+            for (key, counts) in counters.items():
+                for (field, count) in counts.items():
+                    pipe.hincrby(key, field, count)
+            for (key, expire) in expiries.items():
+                pipe.expireat(key, datetime.datetime.combine(expire,
+                                                             datetime.time()))
+            pipe.execute()
+        except Exception as e:
+            # Analytics are best effort. Dropping a batch is better than
+            # letting the buffer grow while redis is down.
+            self.logger.warning("Could not flush analytics: %s", e)
+
+    def report(self, days=7, chat_ids=None):
+        today = self.today()
+        day_list = [today - datetime.timedelta(days=i) for i in range(days)]
+        pipe = self.store.pipeline(transaction=False)
+        pipe.pfcount(self.keys.monthly_users(self.month_id(today)))
+        for day in day_list:
+            day_key = self.day_id(day)
+            pipe.pfcount(self.keys.daily_users(day_key))
+            pipe.bitcount(self.keys.daily_user_bitmap(day_key))
+            pipe.hgetall(self.keys.daily_commands(day_key))
+        for chat_id in chat_ids or []:
+            pipe.pfcount(self.keys.daily_chat_senders(chat_id,
+                                                      self.day_id(today)))
+        results = pipe.execute()
+        report = {"month": self.month_id(today),
+                  "monthly_active_users": results.pop(0),
+                  "days": [],
+                  "chat_active_senders_today": {}}
+        for day in day_list:
+            (dau, bitmap_count, commands) = results[:3]
+            results = results[3:]
+            report["days"].append({"day": self.day_id(day),
+                                   "active_users": dau,
+                                   "active_users_exact": bitmap_count,
+                                   "commands": {k: int(v) for (k, v) in commands.items()}})
+        for (chat_id, count) in zip(chat_ids or [], results):
+            if count > 0:
+                report["chat_active_senders_today"][str(chat_id)] = count
+        return report
+
+    def format_report(self, report):
+        msg = "Activity for {0}: {1} monthly active users\n\n".format(report["month"],
+                                                                      report["monthly_active_users"])
+        for day in report["days"]:
+            msg += "{0} - {1} active users\n".format(day["day"],
+                                                     day["active_users"])
+            commands = sorted(day["commands"].items(),
+                              key=lambda c: c[1], reverse=True)
+            if commands:
+                msg += "- Commands: {0}\n".format(", ".join("/{0} ({1})".format(c, n) for (c, n) in commands))
+        if report["chat_active_senders_today"]:
+            msg += "\nActive senders in groups today:\n"
+            for (chat_id, count) in report["chat_active_senders_today"].items():
+                msg += "{0} - {1}\n".format(chat_id, count)
+        return msg
+
+    def show_stats(self, bot, update, chats=None):
+        self.flush()
+        chat_ids = chats.trans.get_chat_ids() if chats is not None else None
+        bot.sendMessage(update.message.chat.id,
+                        text=self.format_report(self.report(chat_ids=chat_ids)))
+
+    def export_stats(self, bot, update, chats=None):
+        self.flush()
+        chat_ids = chats.trans.get_chat_ids() if chats is not None else None
+        report = self.report(days=31, chat_ids=chat_ids)
+        export = io.BytesIO(json.dumps(report, indent=2).encode("utf-8"))
+        export.name = "stats-{0}.json".format(self.day_id(self.today()))
+        bot.sendDocument(update.message.chat.id,
+                         document=export,
+                         filename=export.name)
@@ -2,8 +2,15 @@ import logging
 
 
 class NPModuleBase(object):
-    def __init__(self, logger_name):
+    def __init__(self, logger_name, errors=None):
         self.logger = logging.getLogger(logger_name)
+        # ErrorTracker to report caught exceptions to, if any
+        self.errors = errors
 
     def commands(self):
         return ""
+
+    def report_error(self, error, context=None):
+        self.logger.warning("Exception thrown! %s", error, exc_info=error)
+        if self.errors is not None:
+            self.errors.record(error, context)
@@ -1,10 +1,12 @@
+from .errors import update_context
 from telegram.ext.dispatcher import Dispatcher
 from telegram import TelegramError
-from threading import Event
+from threading import Event, Lock, get_ident
+import functools
 
 
 class BlockDispatcher(Dispatcher):
-    def __init__(self, updater, user_manager):
+    def __init__(self, updater, user_manager, analytics=None, errors=None):
         # Build a new dispatcher based on the same settings as we get from the
         # updater.
         # TODO Probably shouldn't hard code workers but eh.
@@ -13,13 +15,50 @@ class BlockDispatcher(Dispatcher):
                          4,
                          Event())
         self.um = user_manager
+        self.analytics = analytics
+        self.errors = errors
+        # Ids of every thread that has processed an update, so the profiler
+        # knows which threads to sample. Read it through get_worker_threads,
+        # dispatcher threads add to it while the profiler reads it.
+        self.worker_threads = set()
+        self.worker_threads_lock = Lock()
         # Replace the updater's dispatcher with this one
         updater.dispatcher = self
 
+    # The dispatcher only hands TelegramErrors to the error handlers, anything
+    # else a handler raises is logged and dropped. Wrap each handler so those
+    # get recorded too, then re-raise so the dispatcher carries on as before.
+    def add_handler(self, handler, *args, **kwargs):
+        if self.errors is not None:
+            handle_update = handler.handle_update
+
+            @functools.wraps(handle_update)
+            def recorded_handle_update(update, dispatcher):
+                try:
+                    return handle_update(update, dispatcher)
+                except TelegramError:
+                    raise
+                except Exception as e:
+                    self.errors.record(e, update_context(update))
+                    raise
+            handler.handle_update = recorded_handle_update
+        super().add_handler(handler, *args, **kwargs)
+
+    def get_worker_threads(self):
+        with self.worker_threads_lock:
+            return set(self.worker_threads)
+
     def processUpdate(self, update):
+        thread_id = get_ident()
+        # Only take the lock the first time a thread shows up
+        if thread_id not in self.worker_threads:
+            with self.worker_threads_lock:
+                self.worker_threads.add(thread_id)
         # An error happened while polling
         if isinstance(update, TelegramError):
             self.dispatchError(None, update)
         if self.um.is_blocked(update):
             return
+        if self.analytics is not None:
+            self.analytics.record_update(update)
         super().processUpdate(update)
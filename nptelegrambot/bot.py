@@ -1,51 +1,203 @@
 from telegram.ext import Updater, MessageHandler, Filters, CommandHandler
+from telegram import TelegramError, Update
 from .permissioncommandhandler import PermissionCommandHandler
 from .users import UserManager
 from .conversations import ConversationManager, ConversationHandler
 from .chats import ChatManager
 from .blockdispatcher import BlockDispatcher
+from .keyschema import RedisKeySchema
+from .analytics import ActivityTracker
+from .profiler import SamplingProfiler
+from .errors import ErrorTracker, update_context
+from .sharding import UpdatePublisher, ShardWorker
+from .responses import ResponseCache
+from .capture import UpdateRecorder
+from .replicas import RedisRouter
 from threading import Thread
 from functools import partial
+from contextlib import contextmanager
+import threading
 import redis
 import argparse
 import logging
 import configparser
+import time
+import io
+import os
 
 
 class NPTelegramBot(object):
     FLAGS = ["admin", "def_edit", "user_flags"]
+    # Bots override these to change the default replies. They're rendered
+    # once at startup, see setup_responses.
+    HELP_TEXT = ["Hi! I'm an NP Telegram Bot! If I'm displaying this message, it means whoever wrote me didn't override the handle_help function. They should do that!"]
+    PRIVMSG_TEXT = "Please message that command to me. Only the following commands are allowed in public chats:\n- /def"
+    PERMISSION_TEXT = "You do not have the required permissions to run this command."
 
     def __init__(self, config):
         self.logger = logging.getLogger(__name__)
         self.config = config
+        # (phase, seconds) pairs, logged once the bot is up.
+        self.startup_times = []
 
         if "token" not in config:
             print("Cannot load token!")
             raise RuntimeError()
         tg_token = config["token"]
 
-        if "redis_host" in config:
-            redis_args = {}
-            redis_args["host"] = config["redis_host"]
-            redis_args["db"] = config["redis_db_num"]
-            if "redis_port" in config:
-                redis_args["port"] = config["redis_port"]
-            if "redis_password" in config:
-                redis_args["password"] = config["redis_password"]
-            self.store = redis.StrictRedis(decode_responses=True,
-                                           **redis_args)
-        else:
+        with self.startup_phase("store"):
+            self.store = self.create_store(config)
+            # User and chat reads can go to replicas, everything else uses
+            # the primary directly.
+            self.router = RedisRouter(self.store,
+                                      self.create_replicas(config),
+                                      int(config.get("redis_replica_max_lag", 5)))
+        # Keys are namespaced per bot so multiple bots can share a redis
+        # database. Defaults to the bot's config section name.
+        self.keys = RedisKeySchema(config.get("redis_key_prefix",
+                                              config.name))
+
+        self.errors = ErrorTracker(int(config.get("error_window", 300)),
+                                   int(config.get("error_samples", 50)),
+                                   int(config.get("error_alerts_per_window", 10)))
+        self.errors.notify = self.send_error_alert
+
+        self.responses = ResponseCache()
+        self.setup_responses()
+
+        # None of the managers touch redis until they're used or warmed up,
+        # see warm_up.
+        with self.startup_phase("managers"):
+            self.conversations = ConversationManager(int(config.get("conversation_timeout", 600)),
+                                                     int(config.get("max_conversations", 1000)),
+                                                     router=self.router)
+            self.users = UserManager(self.router, self.keys, self.responses)
+            self.chats = ChatManager(self.router, self.keys, self.errors)
+            self.chats.add_join_filter(self.chats.block_filter,
+                                       pass_context=True)
+            self.analytics = ActivityTracker(self.store, self.keys,
+                                             int(config.get("analytics_flush_interval", 10)),
+                                             int(config.get("analytics_retention_days", 90)))
+
+        self.profiler = SamplingProfiler()
+        self.profile_max_seconds = int(config.get("profile_max_seconds", 60))
+
+        # In distributed mode, webhook front ends publish updates to sharded
+        # redis streams and shard workers (possibly on other nodes) run the
+        # handlers.
+        self.publisher = None
+        self.shard_worker = None
+        self.shard_thread = None
+        if config.get("distributed", "0") == "1":
+            shard_count = int(config.get("shard_count", 16))
+            self.publisher = UpdatePublisher(self.store, self.keys,
+                                             shard_count)
+            self.shard_worker = ShardWorker(self.store, self.keys,
+                                            shard_count,
+                                            self.process_update_json,
+                                            config.get("worker_id"),
+                                            errors=self.errors)
+
+        # Anonymized copies of incoming webhook updates, for loadtest.py
+        self.recorder = None
+        if "capture_path" in config:
+            self.recorder = UpdateRecorder(config["capture_path"],
+                                           config.name,
+                                           config.get("capture_salt",
+                                                      os.urandom(8).hex()))
+
+        self.thread = None
+        self.warm_up_thread = None
+        updater_args = {}
+        # Lets the load test point the bot at a stub API server
+        if "telegram_base_url" in config:
+            updater_args["base_url"] = config["telegram_base_url"]
+        with self.startup_phase("updater"):
+            self.updater = Updater(token=tg_token, **updater_args)
+            self.dispatcher = BlockDispatcher(self.updater, self.users,
+                                              self.analytics, self.errors)
+
+    def setup_responses(self):
+        self.responses.add_message("help", self.HELP_TEXT)
+        self.responses.add_message("privmsg", self.PRIVMSG_TEXT)
+        self.responses.add_message("permission", self.PERMISSION_TEXT)
+
+    @contextmanager
+    def startup_phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.startup_times.append((name, time.monotonic() - start))
+
+    def log_startup_times(self):
+        total = sum(t for (_, t) in self.startup_times)
+        self.logger.info("Bot %s started in %.3fs (%s)", self.config.name, total,
+                         ", ".join("{0} {1:.3f}s".format(n, t) for (n, t) in self.startup_times))
+
+    def warm_up(self):
+        # Redis setup the managers need before they're fully useful. Anything
+        # not loaded by the time an update needs it gets loaded on demand,
+        # but the built in user and chat flags are only created here, so keep
+        # retrying until redis is reachable.
+        start = time.monotonic()
+        delay = 1
+        while True:
+            try:
+                self.users.warm_up()
+                self.chats.warm_up()
+                break
+            except Exception as e:
+                self.logger.warning("Warm up failed, retrying in %d seconds: %s",
+                                    delay, e, exc_info=e)
+                self.errors.record(e, "warm up")
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+        self.logger.info("Bot %s warmed up in %.3fs", self.config.name,
+                         time.monotonic() - start)
+
+    def start_warm_up(self):
+        self.warm_up_thread = Thread(target=self.warm_up, name='warmup',
+                                     daemon=True)
+        self.warm_up_thread.start()
+
+    @staticmethod
+    def create_store(config, host=None, port=None, timeout=None):
+        if "redis_host" not in config:
             print("No backing store specified in config file!")
             raise RuntimeError()
+        redis_args = {}
+        redis_args["host"] = host or config["redis_host"]
+        redis_args["db"] = config["redis_db_num"]
+        if port is not None:
+            redis_args["port"] = port
+        elif "redis_port" in config:
+            redis_args["port"] = config["redis_port"]
+        if "redis_password" in config:
+            redis_args["password"] = config["redis_password"]
+        if timeout is not None:
+            redis_args["socket_timeout"] = timeout
+            redis_args["socket_connect_timeout"] = timeout
+        return redis.StrictRedis(decode_responses=True,
+                                 **redis_args)
 
-        self.conversations = ConversationManager()
-        self.users = UserManager(self.store)
-        self.chats = ChatManager(self.store)
-        self.chats.add_join_filter(self.chats.block_filter)
-
-        self.thread = None
-        self.updater = Updater(token=tg_token)
-        self.dispatcher = BlockDispatcher(self.updater, self.users)
+    @staticmethod
+    def create_replicas(config):
+        # Comma separated host:port list. Replicas share the primary's db
+        # number and password. They get short socket timeouts, so a replica
+        # that stops answering fails over to the primary instead of hanging
+        # the read.
+        replicas = []
+        timeout = float(config.get("redis_replica_timeout", 0.5))
+        for replica in config.get("redis_replicas", "").split(","):
+            replica = replica.strip()
+            if not replica:
+                continue
+            (host, _, port) = replica.partition(":")
+            replicas.append(NPTelegramBot.create_store(config, host,
+                                                       port or None,
+                                                       timeout))
+        return replicas
 
     @staticmethod
     def parse_cli_arguments():
@@ -140,24 +292,49 @@ class NPTelegramBot(object):
                                                         self.conversations,
                                                         partial(self.chats.leave_chat, block=True)))
 
+        self.dispatcher.add_handler(PermissionCommandHandler('stats',
+                                                             [self.require_privmsg,
+                                                              partial(self.require_flag, flag="admin")],
+                                                             partial(self.analytics.show_stats, chats=self.chats)))
+        self.dispatcher.add_handler(PermissionCommandHandler('statsexport',
+                                                             [self.require_privmsg,
+                                                              partial(self.require_flag, flag="admin")],
+                                                             partial(self.analytics.export_stats, chats=self.chats)))
+        self.dispatcher.add_handler(PermissionCommandHandler('profile',
+                                                             [self.require_privmsg,
+                                                              partial(self.require_flag, flag="admin")],
+                                                             self.handle_profile,
+                                                             pass_args=True))
+        self.dispatcher.add_handler(PermissionCommandHandler('errors',
+                                                             [self.require_privmsg,
+                                                              partial(self.require_flag, flag="errors")],
+                                                             self.errors.list_errors))
+
         # self.dispatcher.add_handler(PermissionCommandHandler('outputcommands',
         #                                                      [self.require_privmsg,
         #                                                       partial(self.require_flag, flag="admin")],
         #                                                      self.output_commands))
 
-        # On errors, just print to console and hope someone sees it
+        # On errors, log and alert users with the errors flag
         self.dispatcher.add_error_handler(self.handle_error)
 
     def handle_help(self, bot, update):
-        help_text = ["Hi! I'm an NP Telegram Bot! If I'm displaying this message, it means whoever wrote me didn't override the handle_help function. They should do that!"]
         bot.sendMessage(update.message.chat.id,
-                        "\n".join(help_text),
+                        self.responses.message("help"),
                         parse_mode="HTML",
                         disable_web_page_preview=True)
 
     def handle_error(self, bot, update, error):
-        # TODO Add ability for bot to message owner with stack traces
-        self.logger.warn("Exception thrown! %s", error)
+        self.logger.warning("Exception thrown! %s", error, exc_info=error)
+        self.errors.record(error, update_context(update))
+
+    def send_error_alert(self, text):
+        for user_id in self.users.trans.get_flag_users("errors"):
+            try:
+                self.updater.bot.sendMessage(user_id, text=text)
+            except Exception as e:
+                self.logger.warning("Could not send error alert to %s: %s",
+                                    user_id, e)
 
     def try_register(self, bot, update):
         user_id = update.message.from_user.id
@@ -174,7 +351,7 @@ class NPTelegramBot(object):
         user_id = update.message.from_user.id
         if not self.users.is_valid_user(user_id) or not self.users.has_flag(user_id, flag):
             bot.sendMessage(update.message.chat.id,
-                            text="You do not have the required permissions to run this command.")
+                            text=self.responses.message("permission"))
             return False
         return True
 
@@ -182,10 +359,67 @@ class NPTelegramBot(object):
         if update.message.chat.id < 0:
             bot.sendMessage(update.message.chat.id,
                             reply_to_message_id=update.message.id,
-                            text="Please message that command to me. Only the following commands are allowed in public chats:\n- /def")
+                            text=self.responses.message("privmsg"))
             return False
         return True
 
+    def dispatcher_thread_ids(self):
+        alive = set(t.ident for t in threading.enumerate())
+        return [t for t in self.dispatcher.get_worker_threads() if t in alive]
+
+    def run_profile(self, seconds):
+        seconds = max(1, min(seconds, self.profile_max_seconds))
+        self.logger.info("Profiling dispatcher threads for %d seconds", seconds)
+        return self.profiler.profile(seconds, self.dispatcher_thread_ids)
+
+    def handle_profile(self, bot, update, args):
+        try:
+            seconds = int(args[0]) if args else 10
+        except ValueError:
+            bot.sendMessage(update.message.chat.id,
+                            text="Usage: /profile [seconds], up to {0} seconds.".format(self.profile_max_seconds))
+            return
+        chat_id = update.message.chat.id
+        if not self.start_profile(seconds, [chat_id]):
+            bot.sendMessage(chat_id, text="A profile is already running!")
+            return
+        bot.sendMessage(chat_id,
+                        text="Profiling dispatcher threads for {0} seconds.".format(max(1, min(seconds, self.profile_max_seconds))))
+
+    # Profiles from a separate thread, otherwise we'd just be profiling
+    # ourselves waiting, and sends the result to each of chat_ids. Returns
+    # False if a profile is already running.
+    def start_profile(self, seconds, chat_ids):
+        if self.profiler.is_running():
+            return False
+        bot = self.updater.bot
+
+        def profile():
+            result = self.run_profile(seconds)
+            for chat_id in chat_ids:
+                try:
+                    if result is None:
+                        bot.sendMessage(chat_id, text="A profile is already running!")
+                        continue
+                    bot.sendMessage(chat_id, text=result.summary())
+                    if result.samples > 0:
+                        collapsed = io.BytesIO(result.collapsed().encode("utf-8"))
+                        collapsed.name = "profile-{0}-{1}.collapsed".format(os.getpid(),
+                                                                            int(time.time()))
+                        bot.sendDocument(chat_id,
+                                         document=collapsed,
+                                         filename=collapsed.name)
+                except Exception as e:
+                    self.logger.warning("Could not send profile to %s: %s",
+                                        chat_id, e)
+        Thread(target=profile, name='profiler', daemon=True).start()
+        return True
+
+    # For the webhook front end's /profile route
+    def start_admin_profile(self, seconds):
+        return self.start_profile(seconds,
+                                  self.users.trans.get_flag_users("admin"))
+
     def output_commands(self, bot, update):
         command_str = ""
         for m in self.modules:
@@ -206,26 +440,84 @@ class NPTelegramBot(object):
         if "webhook_url" not in self.config:
             print("No webhook URL to bind to!")
             raise RuntimeError()
-        self.updater.bot.setWebhook(webhook_url=self.config["webhook_url"])
+        with self.startup_phase("webhook"):
+            self.register_webhook(self.config["webhook_url"])
         # Steal the queue from the updater.
         self.update_queue = self.updater.update_queue
-        self.thread = Thread(target=self.dispatcher.start, name='dispatcher')
-        self.thread.start()
+        if self.publisher is None:
+            self.thread = Thread(target=self.dispatcher.start,
+                                 name='dispatcher')
+            self.thread.start()
+        elif self.config.get("distributed_worker", "0") == "1":
+            # Front end that also works shards itself
+            self.start_shard_worker_thread()
+        self.conversations.start()
+        self.analytics.start()
+
+    def register_webhook(self, url):
+        # Every process start would otherwise re-register the same URL, which
+        # is a slow round trip to telegram.
+        try:
+            current = self.updater.bot.getWebhookInfo().url
+        except (AttributeError, TelegramError) as e:
+            self.logger.debug("Could not get webhook info: %s", e)
+            current = None
+        if current == url:
+            self.logger.debug("Webhook already set to %s", url)
+            return
+        self.updater.bot.setWebhook(webhook_url=url)
 
     def add_webhook_update(self, update):
         self.update_queue.put(update)
 
+    # Takes the update JSON as posted to the webhook.
+    def handle_webhook_update(self, data):
+        if self.recorder is not None:
+            self.recorder.record(data)
+        if self.publisher is not None:
+            self.publisher.publish(data)
+            return
+        self.add_webhook_update(Update.de_json(data))
+
+    def process_update_json(self, data):
+        self.dispatcher.processUpdate(Update.de_json(data))
+
+    def start_shard_worker_thread(self):
+        self.shard_thread = Thread(target=self.shard_worker.run,
+                                   name='dispatcher-shards')
+        self.shard_thread.start()
+
     def start_loop(self):
+        self.start_warm_up()
+        self.conversations.start()
+        self.analytics.start()
+        if self.shard_worker is not None:
+            # Updates come from the shard streams, not from polling.
+            try:
+                self.shard_worker.run()
+            except KeyboardInterrupt:
+                pass
+            return
         self.updater.start_polling()
         self.updater.idle()
 
     def shutdown(self):
+        if self.shard_worker is not None:
+            self.shard_worker.stop()
+        if self.shard_thread:
+            self.shard_thread.join(self.shard_worker.block + 1)
         if self.thread:
             self.thread.join(1)
+        self.conversations.shutdown()
+        self.chats.shutdown()
+        self.analytics.stop()
 
 
 def create_webhook_bot(config):
     bot = NPTelegramBot(config)
-    bot.setup_commands()
+    with bot.startup_phase("commands"):
+        bot.setup_commands()
     bot.start_webhook_thread()
+    bot.start_warm_up()
+    bot.log_startup_times()
     return bot
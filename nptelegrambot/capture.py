@@ -0,0 +1,84 @@
+# Records incoming webhook updates, anonymized, for replaying with
+# loadtest.py. User, chat and message ids are replaced with stable hashes
+# (keeping their sign, so groups still look like groups), names, addresses and
+# file ids are replaced with hashes, coordinates are zeroed, payloads like
+# vcards and payment details are dropped, and message text is scrambled except
+# for the /command at its start, so the replay hits the same handlers without
+# carrying anyone's messages or whereabouts.
+from threading import Lock
+import hashlib
+import json
+import time
+
+ID_FIELDS = ["id", "message_id", "migrate_to_chat_id", "migrate_from_chat_id",
+             "user_id"]
+NAME_FIELDS = ["first_name", "last_name", "username", "title",
+               "phone_number", "address", "foursquare_id", "google_place_id",
+               "email", "file_name", "file_id", "file_unique_id", "file_path",
+               "bio", "description", "invite_link", "forward_sender_name",
+               "author_signature", "url"]
+TEXT_FIELDS = ["text", "caption", "query", "data", "new_chat_title",
+               "question", "explanation"]
+# Location, venue and live location coordinates
+GEO_FIELDS = ["latitude", "longitude", "horizontal_accuracy", "heading",
+              "proximity_alert_radius"]
+# Not needed to replay and too personal to keep in any form
+DROP_FIELDS = ["vcard", "order_info", "shipping_address", "passport_data",
+               "credentials"]
+
+
+def anonymize_id(value, salt):
+    digest = hashlib.sha1("{0}:{1}".format(salt, value).encode("utf-8")).hexdigest()
+    anon = int(digest[:12], 16) % 2 ** 31 + 1
+    return -anon if value < 0 else anon
+
+
+def anonymize_text(text):
+    command = ""
+    if text.startswith("/"):
+        (command, _, text) = text.partition(" ")
+        if text:
+            command += " "
+    return command + "".join("x" if c.isalnum() else c for c in text)
+
+
+def anonymize(data, salt):
+    if isinstance(data, list):
+        return [anonymize(d, salt) for d in data]
+    if not isinstance(data, dict):
+        return data
+    anon = {}
+    for (key, value) in data.items():
+        if key in DROP_FIELDS:
+            continue
+        if key in GEO_FIELDS and isinstance(value, (int, float)):
+            anon[key] = 0
+        elif key in ID_FIELDS and isinstance(value, int):
+            anon[key] = anonymize_id(value, salt)
+        elif key in NAME_FIELDS and isinstance(value, str):
+            anon[key] = "{0}_{1}".format(key, hashlib.sha1("{0}:{1}".format(salt, value).encode("utf-8")).hexdigest()[:8])
+        elif key in TEXT_FIELDS and isinstance(value, str):
+            anon[key] = anonymize_text(value)
+        else:
+            # Includes entities, whose offset, length and type pass through
+            # (the text keeps its length, so they still line up) while
+            # text_mention users and text_link urls get anonymized.
+            anon[key] = anonymize(value, salt)
+    return anon
+
+
+class UpdateRecorder(object):
+    def __init__(self, path, bot_name, salt):
+        self.path = path
+        self.bot_name = bot_name
+        # Salt keeps the hashed ids from being reversed by hashing known ids
+        self.salt = salt
+        self.lock = Lock()
+
+    def record(self, data):
+        line = json.dumps({"bot": self.bot_name,
+                           "time": time.time(),
+                           "update": anonymize(data, self.salt)})
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
@@ -1,91 +1,165 @@
+from telegram.error import Unauthorized
 from .base import NPModuleBase
+from .replicas import RedisRouter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
 
 
 class ChatRedisTransactions(object):
-    def __init__(self, redis):
-        "docstring"
-        self.redis = redis
+    def __init__(self, redis, keys):
+        # Reads go through the router so they can be served by replicas
+        self.router = redis if isinstance(redis, RedisRouter) else RedisRouter(redis)
+        self.keys = keys
 
     def add_chat(self, chat_id, chat_title, chat_username):
-        self.redis.hmset(chat_id, {"id": chat_id,
-                                   "title": chat_title,
-                                   "username": chat_username})
+        self.router.writer().hmset(self.keys.chat(chat_id), {"id": chat_id,
+                                                             "title": chat_title,
+                                                             "username": chat_username})
 
     def set_chat_title(self, chat_id, chat_title):
-        self.redis.hset(chat_id, "title", chat_title)
+        self.router.writer().hset(self.keys.chat(chat_id), "title", chat_title)
 
     def set_chat_username(self, chat_id, chat_username):
-        self.redis.hset(chat_id, "username", chat_username)
+        self.router.writer().hset(self.keys.chat(chat_id), "username", chat_username)
 
     def get_chat(self, chat_id):
-        return self.redis.hgetall(chat_id)
+        return self.router.read("hgetall", self.keys.chat(chat_id))
 
     def get_chats(self):
-        chats = self.redis.hkeys("chat-status")
-        pipe = self.redis.pipeline()
-        for c in chats:
-            pipe.hgetall(c)
-        return pipe.execute()
+        chats = self.get_chat_ids()
+
+        def build(pipe):
+            for c in chats:
+                pipe.hgetall(self.keys.chat(c))
+        return self.router.read_pipeline(build)
 
     def get_chat_ids(self):
-        return self.redis.hkeys("chat-status")
+        return self.router.read("hkeys", self.keys.chat_status())
 
     def set_chat_id(self, old_chat_id, new_chat_id):
         # In case we switch from group to supergroup. Annoying!
-        self.redis.rename(old_chat_id, new_chat_id)
-        self.redis.rename(self.get_chat_flag_key(old_chat_id),
-                          self.get_chat_flag_key(new_chat_id))
+        self.router.writer().rename(self.keys.chat(old_chat_id),
+                                    self.keys.chat(new_chat_id))
+        self.router.writer().rename(self.get_chat_flag_key(old_chat_id),
+                                    self.get_chat_flag_key(new_chat_id))
 
     def update_chat_size(self, chat_id, chat_size):
-        self.redis.hset(chat_id, "size", chat_size)
-        self.redis.hset("chat-size", chat_id, chat_size)
+        self.router.writer().hset(self.keys.chat(chat_id), "size", chat_size)
+        self.router.writer().hset(self.keys.chat_size(), chat_id, chat_size)
 
     def update_chat_status(self, chat_id, chat_status):
-        self.redis.hset(chat_id, "status", chat_status)
-        self.redis.hset("chat-status", chat_id, chat_status)
+        self.router.writer().hset(self.keys.chat(chat_id), "status", chat_status)
+        self.router.writer().hset(self.keys.chat_status(), chat_id, chat_status)
+
+    def save_joined_chat(self, chat_id, chat_title, chat_username,
+                         chat_status, chat_size):
+        # Everything add_chat, update_chat_status and update_chat_size write,
+        # in one round trip.
+        pipe = self.router.writer().pipeline()
+        pipe.hmset(self.keys.chat(chat_id), {"id": chat_id,
+                                             "title": chat_title,
+                                             "username": chat_username,
+                                             "status": chat_status,
+                                             "size": chat_size})
+        pipe.hset(self.keys.chat_status(), chat_id, chat_status)
+        pipe.hset(self.keys.chat_size(), chat_id, chat_size)
+        pipe.execute()
 
     def get_chat_flag_key(self, chat_id):
-        return "{0}:flags".format(chat_id)
+        return self.keys.chat_flags(chat_id)
 
     def get_chat_flags(self, chat_id):
-        return self.redis.smembers(self.get_chat_flag_key(chat_id))
+        return self.router.read("smembers", self.get_chat_flag_key(chat_id))
 
     def add_chat_flag(self, chat_id, flag):
-        self.redis.sadd(self.get_chat_flag_key(chat_id), flag)
+        self.router.writer().sadd(self.get_chat_flag_key(chat_id), flag)
 
     def get_flags(self):
-        self.redis.smembers("chat-flags")
+        return self.router.read("smembers", self.keys.chat_flag_list())
 
     def add_flag(self, flag):
-        self.redis.sadd("chat-flags", flag)
+        self.router.writer().sadd(self.keys.chat_flag_list(), flag)
 
     def remove_flag(self, flag):
-        self.redis.srem("chat-flags", flag)
-
-
+        self.router.writer().srem(self.keys.chat_flag_list(), flag)
+
+
+class JoinContext(object):
+    # Chat info shared by all join filters for one join. Each value is fetched
+    # the first time a filter asks for it, and only once even if several
+    # filters running at the same time ask together.
+    def __init__(self, bot, chat_id, trans):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.trans = trans
+        self.lock = Lock()
+        self.value_locks = {}
+        self.values = {}
+
+    def get(self, name, fetch):
+        if name in self.values:
+            return self.values[name]
+        with self.lock:
+            value_lock = self.value_locks.setdefault(name, Lock())
+        with value_lock:
+            if name not in self.values:
+                self.values[name] = fetch()
+        return self.values[name]
+
+    @property
+    def member_count(self):
+        return self.get("member_count",
+                        lambda: self.bot.getChatMembersCount(self.chat_id))
+
+    @property
+    def member_status(self):
+        return self.get("member_status",
+                        lambda: self.bot.getChatMember(self.chat_id,
+                                                       self.bot.id)["status"])
+
+    @property
+    def chat_flags(self):
+        return self.get("chat_flags",
+                        lambda: self.trans.get_chat_flags(self.chat_id))
+
+
+# Join filters are called with (bot, update), and also get the join's
+# JoinContext as a context keyword argument if they were added with
+# pass_context=True. They return None to allow the join, or a reason to leave
+# the chat.
 class ChatFilters(object):
     @staticmethod
-    def min_size_filter(bot, update, min_size):
-        count = bot.get_chat_member_count(update.message.chat.id)
-        if count <= min_size:
+    def member_count(bot, update, context):
+        if context is not None:
+            return context.member_count
+        return bot.getChatMembersCount(update.message.chat.id)
+
+    @staticmethod
+    def min_size_filter(bot, update, min_size, context=None):
+        if ChatFilters.member_count(bot, update, context) <= min_size:
             return "Chat size is less than {0} members.".format(min_size)
         return None
 
     @staticmethod
-    def max_size_filter(bot, update, max_size):
-        count = bot.get_chat_member_count(update.message.chat.id)
-        if count >= max_size:
+    def max_size_filter(bot, update, max_size, context=None):
+        if ChatFilters.member_count(bot, update, context) >= max_size:
             return "Chat size is greater than {0} members.".format(max_size)
         return None
 
 
 class ChatManager(NPModuleBase):
-    def __init__(self, redis):
-        super().__init__(__name__)
-        self.trans = ChatRedisTransactions(redis)
+    def __init__(self, redis, keys, errors=None, filter_workers=4):
+        super().__init__(__name__, errors)
+        self.trans = ChatRedisTransactions(redis, keys)
+        # (filter, pass_context) pairs
+        self.join_filters = []
+        # Join filters mostly wait on telegram or redis, so run them side by
+        # side.
+        self.filter_executor = ThreadPoolExecutor(max_workers=filter_workers)
+
+    def warm_up(self):
         # Just always add the block flag. Doesn't matter if it's already there.
         self.trans.add_flag("block")
-        self.join_filters = []
 
     def process_status_update(self, bot, update):
         if update.message.new_chat_member:
@@ -101,17 +175,56 @@ class ChatManager(NPModuleBase):
         elif update.message.new_chat_title:
             self.process_new_chat_title(bot, update)
 
+    # Returns the JoinContext if the bot can stay in the chat, None if it
+    # left.
     def run_join_checks(self, bot, update):
         chat = update.message.chat
-        for f in self.join_filters:
-            reason = f(bot, update)
-            if reason is not None:
-                if type(reason) is str:
-                    bot.sendMessage(chat.id,
-                                    text="Sorry, I can't be in this chat! {0}".format(reason if type(reason) is str else ""))
-                bot.leaveChat(chat.id)
-                return False
-        return True
+        context = JoinContext(bot, chat.id, self.trans)
+        reason = self.first_rejection(bot, update, context)
+        if reason is None:
+            return context
+        if type(reason) is str:
+            bot.sendMessage(chat.id,
+                            text="Sorry, I can't be in this chat! {0}".format(reason))
+        bot.leaveChat(chat.id)
+        return None
+
+    @staticmethod
+    def run_join_filter(join_filter, pass_context, bot, update, context):
+        if pass_context:
+            return join_filter(bot, update, context=context)
+        return join_filter(bot, update)
+
+    # Runs a join filter on a pool thread, reading from wherever the thread
+    # that handled the join would have.
+    def run_pooled_join_filter(self, pinned_until, *args):
+        with self.trans.router.pinned(pinned_until):
+            return self.run_join_filter(*args)
+
+    def first_rejection(self, bot, update, context):
+        if len(self.join_filters) == 1:
+            # Not worth a trip through the thread pool
+            return self.run_join_filter(*self.join_filters[0], bot, update,
+                                        context)
+        pinned_until = self.trans.router.pinned_until()
+        pending = set(self.filter_executor.submit(self.run_pooled_join_filter,
+                                                  pinned_until, f,
+                                                  pass_context, bot, update,
+                                                  context)
+                      for (f, pass_context) in self.join_filters)
+        while pending:
+            (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Filter exceptions propagate, same as when filters ran
+                # inline.
+                reason = future.result()
+                if reason is not None:
+                    # Nothing left needs to run. Filters that already started
+                    # finish in the background.
+                    for other in pending:
+                        other.cancel()
+                    return reason
+        return None
 
     def process_new_chat_member(self, bot, update):
         # from will be user that invited member, if any
@@ -121,13 +234,13 @@ class ChatManager(NPModuleBase):
             chat_size = bot.getChatMembersCount(chat.id)
             self.trans.update_chat_size(chat.id, chat_size)
             return
-        if not self.run_join_checks(bot, update):
+        context = self.run_join_checks(bot, update)
+        if context is None:
             return
-        self.trans.add_chat(chat.id, chat.title, chat.username)
-        member_info = bot.getChatMember(chat.id, bot.id)
-        self.trans.update_chat_status(chat.id, member_info["status"])
-        chat_size = bot.getChatMembersCount(chat.id)
-        self.trans.update_chat_size(chat.id, chat_size)
+        # Reuses whatever the join filters already fetched
+        self.trans.save_joined_chat(chat.id, chat.title, chat.username,
+                                    context.member_status,
+                                    context.member_count)
 
     def process_left_chat_member(self, bot, update):
         # from will be user that kicked member, if any
@@ -172,26 +285,33 @@ class ChatManager(NPModuleBase):
                 try:
                     bot.sendMessage(c["id"],
                                     text=message)
-                except:
-                    # If we errored out, we've been kicked from the channel.
-                    # Since telegram doesn't notify us we've been kicked, this
-                    # is our only way to know. Update our status accordingly.
+                except Unauthorized:
+                    # If we're unauthorized, we've been kicked from the
+                    # channel. Since telegram doesn't notify us we've been
+                    # kicked, this is our only way to know. Update our status
+                    # accordingly.
                     self.trans.update_chat_status(c["id"], "kicked")
+                except Exception as e:
+                    # Keep going so one bad chat doesn't stop the broadcast.
+                    self.report_error(e, "broadcast to chat {0}".format(c["id"]))
+
+    # pass_context=True for filters that take the JoinContext, so they share
+    # its lookups with the other filters.
+    def add_join_filter(self, join_filter, pass_context=False):
+        self.join_filters.append((join_filter, pass_context))
 
-    def add_join_filter(self, join_filter):
-        self.join_filters.append(join_filter)
+    def shutdown(self):
+        self.filter_executor.shutdown(wait=False)
 
     def list_known_chats(self, bot, update):
         chats = self.trans.get_chats()
         msg = "Chats I know about and my status in them:\n\n"
         for c in chats:
-            try:
-                msg += "{0} - {1}\n".format(c["title"], c["id"])
-                msg += "- Status: {0}\n".format(c["status"])
-                #msg += "- Size: {0}\n\n".format(c["size"])
-            except:
-                #TODO Fixed left chat info!
-                pass
+            # Chats we've left may be missing fields
+            msg += "{0} - {1}\n".format(c.get("title", "(unknown title)"),
+                                        c.get("id", "(unknown id)"))
+            msg += "- Status: {0}\n".format(c.get("status", "unknown"))
+            #msg += "- Size: {0}\n\n".format(c["size"])
         bot.sendMessage(update.message.chat.id,
                         text=msg)
 
@@ -210,8 +330,8 @@ class ChatManager(NPModuleBase):
         if block:
             self.trans.add_chat_flag(leave_chat["id"], "block")
 
-    def block_filter(self, bot, update):
-        flags = self.trans.get_chat_flags(update.message.chat.id)
+    def block_filter(self, bot, update, context):
+        flags = context.chat_flags
         if flags is not None and "block" in flags:
             # Don't actually tell chat they're banned.
             return "This channel is blocked!"
@@ -1,6 +1,10 @@
-from telegram import ReplyKeyboardHide
 from .base import NPModuleBase
+from .responses import HIDE_KEYBOARD
 from .permissioncommandhandler import PermissionCommandHandler
+from .timerwheel import TimerWheel
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Thread, Event, RLock
 
 
 class ConversationHandler(PermissionCommandHandler):
@@ -18,31 +22,119 @@ class ConversationHandler(PermissionCommandHandler):
 
     def run_generator(self, bot, update):
         c = self.generator(bot, update)
-        c.send(None)
-        self.cm.add(update, c)
+        with self.cm.primary_reads():
+            c.send(None)
+        self.cm.add(update, c, bot)
 
 
 class ConversationManager(NPModuleBase):
-    def __init__(self):
+    def __init__(self, timeout=600, max_conversations=1000, tick=1,
+                 router=None):
         # Conversations only survive as long as the process, so no need to
         # pickledb here.
         super().__init__(__name__)
-        # Conversation dictionary. Key will be user id for the conversation.
-        # Value will get a generator object.
-        self.conversations = {}
+        # Conversation dictionary. Key will be (chat id, user id) for the
+        # conversation. Value will get a generator object. Kept in least
+        # recently used order, so the oldest conversation is first in line
+        # for eviction.
+        self.conversations = OrderedDict()
+        # Last bot object seen for each conversation, needed to tell the user
+        # when their conversation is ended for them.
+        self.bots = {}
+        self.timeout = timeout
+        self.max_conversations = max_conversations
+        self.timers = TimerWheel(tick)
+        self.lock = RLock()
+        self.stop_event = Event()
+        self.thread = None
+        # Steps can be minutes apart, far longer than a write pins reads to
+        # the redis primary, so conversation steps always read from the
+        # primary and see what earlier steps wrote.
+        self.router = router
 
-    def add(self, update, conversation):
-        self.conversations[(update.message.chat.id,
-                            update.message.from_user.id)] = conversation
+    @contextmanager
+    def primary_reads(self):
+        if self.router is None:
+            yield
+            return
+        with self.router.pinned():
+            yield
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self.run_timers, name='conversations',
+                             daemon=True)
+        self.thread.start()
+
+    def run_timers(self):
+        while not self.stop_event.wait(self.timers.tick):
+            with self.lock:
+                ended = [self.remove(conv_id)
+                         for conv_id in self.timers.advance()]
+            for (conv_id, conversation, bot) in ended:
+                self.end(conv_id, conversation, bot,
+                         "This command timed out, you'll need to start it again.")
+
+    # Must be called with the lock held. Returns what end() needs.
+    def remove(self, conv_id):
+        self.timers.cancel(conv_id)
+        return (conv_id,
+                self.conversations.pop(conv_id, None),
+                self.bots.pop(conv_id, None))
+
+    def end(self, conv_id, conversation, bot, text):
+        if conversation is not None:
+            try:
+                conversation.close()
+            except ValueError:
+                # Generator is running in another thread right now, it'll
+                # just never get resumed.
+                pass
+        if bot is None:
+            return
+        try:
+            # Kill any currently displayed keyboard
+            bot.sendMessage(conv_id[0],
+                            text=text,
+                            reply_markup=HIDE_KEYBOARD)
+        except Exception as e:
+            self.logger.warning("Could not end conversation %s: %s",
+                                conv_id, e)
+
+    def add(self, update, conversation, bot=None):
+        conv_id = (update.message.chat.id, update.message.from_user.id)
+        evicted = []
+        with self.lock:
+            if conv_id in self.conversations:
+                # Starting a new command replaces the old one silently
+                (_, old, _) = self.remove(conv_id)
+                evicted.append((conv_id, old, None))
+            self.conversations[conv_id] = conversation
+            self.bots[conv_id] = bot
+            self.timers.schedule(conv_id, self.timeout)
+            while len(self.conversations) > self.max_conversations:
+                oldest = next(iter(self.conversations))
+                evicted.append(self.remove(oldest))
+        for (old_id, old, old_bot) in evicted:
+            self.end(old_id, old, old_bot,
+                     "This command was cancelled, you'll need to start it again.")
 
     def check(self, bot, update):
         conv_id = (update.message.chat.id, update.message.from_user.id)
-        if conv_id not in self.conversations.keys():
-            return False
+        with self.lock:
+            if conv_id not in self.conversations:
+                return False
+            conversation = self.conversations[conv_id]
+            self.conversations.move_to_end(conv_id)
+            self.bots[conv_id] = bot
+            self.timers.schedule(conv_id, self.timeout)
         try:
             # send only takes a single argument, so case up the current bot and
             # update in a tuple
-            self.conversations[conv_id].send((bot, update))
+            with self.primary_reads():
+                conversation.send((bot, update))
         except StopIteration:
             self.cancel(bot, update)
         return True
@@ -50,19 +142,29 @@ class ConversationManager(NPModuleBase):
     def cancel(self, bot, update, conv_ended=False):
         chat_id = update.message.chat.id
         user_id = update.message.from_user.id
-        if (chat_id, user_id) not in self.conversations.keys():
+        with self.lock:
+            if (chat_id, user_id) not in self.conversations:
+                conversation = None
+            else:
+                (_, conversation, _) = self.remove((chat_id, user_id))
+        if conversation is None:
             bot.sendMessage(update.message.chat.id,
                             text="Don't have anything to cancel!",
-                            reply_markup=ReplyKeyboardHide())
+                            reply_markup=HIDE_KEYBOARD)
             return False
-        del self.conversations[(chat_id, user_id)]
-        # Kill any currently displayed keyboard
-        bot.sendMessage(update.message.chat.id,
-                        text="Command finished!",
-                        reply_markup=ReplyKeyboardHide())
+        self.end((chat_id, user_id), conversation, bot, "Command finished!")
         return True
 
     def shutdown(self):
-        for (chat_id, c) in self.conversations:
-            # Send a message here saying we're shutting down?
-            pass
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(self.timers.tick)
+            self.thread = None
+        # Generators can't be persisted, so close everything that's open and
+        # let the users know to start over.
+        with self.lock:
+            ended = [self.remove(conv_id)
+                     for conv_id in list(self.conversations.keys())]
+        for (conv_id, conversation, bot) in ended:
+            self.end(conv_id, conversation, bot,
+                     "I'm restarting, so this command was cancelled. Please start it again.")
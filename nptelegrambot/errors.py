@@ -0,0 +1,144 @@
+from .base import NPModuleBase
+from collections import deque
+from threading import Lock
+import traceback
+import hashlib
+import time
+
+# Telegram cuts messages off at 4096 characters
+MAX_ALERT_LENGTH = 3500
+
+
+# Where an error happened, for alerts. Only the chat and the command are kept,
+# alerts go to people who shouldn't be reading everyone's messages.
+def update_context(update):
+    message = getattr(update, "message", None)
+    if message is None:
+        return None
+    context = "chat {0}".format(message.chat.id)
+    if message.text and message.text.startswith("/"):
+        context += ", command {0}".format(message.text.split()[0][:64])
+    return context
+
+
+class ErrorTracker(NPModuleBase):
+    def __init__(self, window=300, max_samples=50, max_alerts_per_window=10):
+        super().__init__(__name__)
+        self.window = window
+        self.max_alerts_per_window = max_alerts_per_window
+        self.lock = Lock()
+        # Fingerprint -> aggregate info for that error
+        self.fingerprints = {}
+        # Ring of the most recent occurrences, newest last
+        self.samples = deque(maxlen=max_samples)
+        # Limits how many alerts go out in one window no matter how many
+        # different errors we see, so a storm of distinct errors can't turn
+        # into a storm of messages.
+        self.alert_window_start = 0
+        self.alerts_in_window = 0
+        # Callable taking the alert text. Set by whoever owns the bot.
+        self.notify = None
+
+    @staticmethod
+    def fingerprint(error):
+        # Line numbers are left out so the same failure still matches after a
+        # deploy that moves code around.
+        error_type = type(error)
+        parts = ["{0}.{1}".format(error_type.__module__, error_type.__qualname__)]
+        for frame in traceback.extract_tb(error.__traceback__):
+            parts.append("{0}:{1}".format(frame.filename, frame.name))
+        return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def format_error(error):
+        return "".join(traceback.format_exception(type(error), error,
+                                                  error.__traceback__))
+
+    def record(self, error, context=None):
+        now = time.time()
+        fp = self.fingerprint(error)
+        alert = None
+        with self.lock:
+            info = self.fingerprints.get(fp)
+            if info is None:
+                info = {"fingerprint": fp,
+                        "type": type(error).__name__,
+                        "first_seen": now,
+                        "total": 0,
+                        "window_start": now,
+                        "count": 0,
+                        "suppressed": 0,
+                        "alerted": False}
+                self.fingerprints[fp] = info
+            if now - info["window_start"] >= self.window:
+                info["suppressed"] += info["count"] - 1 if info["alerted"] else info["count"]
+                info["window_start"] = now
+                info["count"] = 0
+                info["alerted"] = False
+            info["count"] += 1
+            info["total"] += 1
+            info["last_seen"] = now
+            info["message"] = str(error)
+            self.samples.append({"fingerprint": fp,
+                                 "time": now,
+                                 "context": context,
+                                 "trace": self.format_error(error)})
+            if not info["alerted"] and self.take_alert_slot(now):
+                info["alerted"] = True
+                alert = self.format_alert(info, self.samples[-1])
+                info["suppressed"] = 0
+        # Send outside the lock, it's a network call.
+        if alert is not None and self.notify is not None:
+            try:
+                self.notify(alert)
+            except Exception as e:
+                # Don't record this one, or a broken notifier would feed
+                # itself.
+                self.logger.warning("Could not send error alert: %s", e)
+        return fp
+
+    # Must be called with the lock held
+    def take_alert_slot(self, now):
+        if now - self.alert_window_start >= self.window:
+            self.alert_window_start = now
+            self.alerts_in_window = 0
+        if self.alerts_in_window >= self.max_alerts_per_window:
+            return False
+        self.alerts_in_window += 1
+        return True
+
+    def format_alert(self, info, sample):
+        msg = "Error {0} ({1}): {2}\n".format(info["fingerprint"],
+                                              info["type"],
+                                              info["message"])
+        msg += "Seen {0} times total".format(info["total"])
+        if info["suppressed"] > 0:
+            msg += ", {0} times unreported since the last alert".format(info["suppressed"])
+        msg += ". Further occurrences in the next {0} seconds won't be reported.\n".format(self.window)
+        if sample["context"]:
+            msg += "Context: {0}\n".format(sample["context"])
+        msg += "\n" + sample["trace"]
+        if len(msg) > MAX_ALERT_LENGTH:
+            msg = msg[:MAX_ALERT_LENGTH // 2] + "\n...\n" + msg[-MAX_ALERT_LENGTH // 2:]
+        return msg
+
+    def summary(self):
+        now = time.time()
+        with self.lock:
+            active = [dict(i) for i in self.fingerprints.values()
+                      if now - i["window_start"] < self.window]
+        if not active:
+            return "No errors in the last {0} seconds.".format(self.window)
+        active.sort(key=lambda i: i["count"], reverse=True)
+        msg = "Errors in the current window:\n\n"
+        for info in active:
+            msg += "{0} - {1} x{2} ({3} total)\n- {4}\n".format(info["fingerprint"],
+                                                                 info["type"],
+                                                                 info["count"],
+                                                                 info["total"],
+                                                                 info["message"])
+        return msg
+
+    def list_errors(self, bot, update):
+        bot.sendMessage(update.message.chat.id,
+                        text=self.summary()[:MAX_ALERT_LENGTH])
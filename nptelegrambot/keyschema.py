@@ -0,0 +1,89 @@
+# Every Redis key a bot uses is built here. Keys look like
+# <prefix>:<type>:<id>[:<field>] for per-object data and <prefix>:<name> for
+# bot-wide sets and hashes, so multiple bots can share one database and bulk
+# operations only need to match <prefix>:*.
+class RedisKeySchema(object):
+    SEPARATOR = ":"
+
+    def __init__(self, prefix):
+        if not prefix:
+            raise RuntimeError("Redis key prefix cannot be empty!")
+        if self.SEPARATOR in prefix or "*" in prefix:
+            raise RuntimeError("Redis key prefix {0} cannot contain ':' or '*'!".format(prefix))
+        self.prefix = prefix
+
+    def key(self, *parts):
+        return self.SEPARATOR.join([self.prefix] + [str(p) for p in parts])
+
+    def pattern(self):
+        return self.key("*")
+
+    # Per-object keys
+    def user(self, user_id):
+        return self.key("user", user_id)
+
+    def user_flags(self, user_id):
+        return self.key("user", user_id, "flags")
+
+    def chat(self, chat_id):
+        return self.key("chat", chat_id)
+
+    def chat_flags(self, chat_id):
+        return self.key("chat", chat_id, "flags")
+
+    # Bot-wide keys
+    def user_flag_list(self):
+        return self.key("user-flags")
+
+    def user_names(self):
+        return self.key("user-names")
+
+    def blocked_users(self):
+        return self.key("blocked-users")
+
+    def chat_flag_list(self):
+        return self.key("chat-flags")
+
+    def chat_status(self):
+        return self.key("chat-status")
+
+    def chat_size(self):
+        return self.key("chat-size")
+
+    # Activity analytics keys, bucketed by UTC day (YYYYMMDD) or month
+    # (YYYYMM)
+    def daily_users(self, day):
+        return self.key("stats", "dau", day)
+
+    def monthly_users(self, month):
+        return self.key("stats", "mau", month)
+
+    def daily_user_bitmap(self, day):
+        return self.key("stats", "active", day)
+
+    # User id -> dense bitmap offset, and the counter handing offsets out
+    def stats_user_index(self):
+        return self.key("stats", "user-index")
+
+    def stats_user_counter(self):
+        return self.key("stats", "user-counter")
+
+    def daily_chat_senders(self, chat_id, day):
+        return self.key("stats", "chat", chat_id, "senders", day)
+
+    def daily_commands(self, day):
+        return self.key("stats", "commands", day)
+
+    # Reverse index of users holding a flag
+    def flag_users(self, flag):
+        return self.key("flag", flag, "users")
+
+    # Distributed dispatch keys
+    def update_stream(self, shard):
+        return self.key("updates", shard)
+
+    def shard_workers(self):
+        return self.key("workers")
+
+    def shard_lease(self, shard):
+        return self.key("updates", shard, "owner")
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# Bulk tools for a bot's redis keys. Run as
+#
+#   python3 -m nptelegrambot.migrate -c config.ini -b bot_name <command>
+#
+# migrate - Move keys from the old unprefixed layout (<id>, <id>:flags,
+#           user-flags, chat-status, ...) into the bot's key prefix.
+# export  - Dump all keys under the bot's prefix to JSON on stdout.
+# delete  - Delete all keys under the bot's prefix.
+# reindex - Rebuild the flag -> users index from each user's flags.
+#
+# All commands work in pipelined batches so large databases don't turn into
+# one round trip per key.
+from .bot import NPTelegramBot
+from .keyschema import RedisKeySchema
+import argparse
+import configparser
+import logging
+import json
+import sys
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+# Bot-wide keys from the old layout, and the schema function that names them
+# now.
+LEGACY_GLOBAL_KEYS = {"user-flags": "user_flag_list",
+                      "user-names": "user_names",
+                      "blocked-users": "blocked_users",
+                      "chat-flags": "chat_flag_list",
+                      "chat-status": "chat_status",
+                      "chat-size": "chat_size"}
+
+
+def legacy_key_target(keys, key):
+    # Maps a key from the old layout to its prefixed name, or None if the key
+    # isn't one of ours. User ids are positive, group ids are negative.
+    if key in LEGACY_GLOBAL_KEYS:
+        return getattr(keys, LEGACY_GLOBAL_KEYS[key])()
+    parts = key.split(":")
+    if len(parts) > 2 or (len(parts) == 2 and parts[1] != "flags"):
+        return None
+    try:
+        obj_id = int(parts[0])
+    except ValueError:
+        return None
+    if len(parts) == 2:
+        return keys.user_flags(obj_id) if obj_id > 0 else keys.chat_flags(obj_id)
+    return keys.user(obj_id) if obj_id > 0 else keys.chat(obj_id)
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def scan_keys(redis, keys, batch_size=DEFAULT_BATCH_SIZE):
+    return redis.scan_iter(match=keys.pattern(), count=batch_size)
+
+
+def migrate_legacy_keys(redis, keys, batch_size=DEFAULT_BATCH_SIZE,
+                        dry_run=False):
+    moved = 0
+    conflicts = []
+    skipped = 0
+    # Materialize the scan first, since renaming while scanning can make SCAN
+    # return keys twice.
+    legacy = []
+    for key in redis.scan_iter(count=batch_size):
+        if key.startswith(keys.prefix + keys.SEPARATOR):
+            continue
+        target = legacy_key_target(keys, key)
+        if target is None:
+            skipped += 1
+            continue
+        legacy.append((key, target))
+    for batch in batches(legacy, batch_size):
+        if dry_run:
+            moved += len(batch)
+            continue
+        pipe = redis.pipeline(transaction=False)
+        for (key, target) in batch:
+            pipe.renamenx(key, target)
+        for ((key, target), renamed) in zip(batch, pipe.execute()):
+            if renamed:
+                moved += 1
+            else:
+                conflicts.append(key)
+    return {"moved": moved, "conflicts": conflicts, "skipped": skipped}
+
+
+def export_keys(redis, keys, batch_size=DEFAULT_BATCH_SIZE):
+    readers = {"string": lambda p, k: p.get(k),
+               "hash": lambda p, k: p.hgetall(k),
+               "set": lambda p, k: p.smembers(k),
+               "zset": lambda p, k: p.zrange(k, 0, -1, withscores=True),
+               "list": lambda p, k: p.lrange(k, 0, -1)}
+    output = {}
+    for batch in batches(scan_keys(redis, keys, batch_size), batch_size):
+        pipe = redis.pipeline(transaction=False)
+        for key in batch:
+            pipe.type(key)
+        types = pipe.execute()
+        pipe = redis.pipeline(transaction=False)
+        exported = []
+        for (key, key_type) in zip(batch, types):
+            if key_type not in readers:
+                logger.warning("Not exporting key %s of type %s", key, key_type)
+                continue
+            readers[key_type](pipe, key)
+            exported.append((key, key_type))
+        for ((key, key_type), value) in zip(exported, pipe.execute()):
+            if key_type == "set":
+                value = sorted(value)
+            output[key] = {"type": key_type, "value": value}
+    return output
+
+
+def delete_keys(redis, keys, batch_size=DEFAULT_BATCH_SIZE):
+    deleted = 0
+    for batch in batches(list(scan_keys(redis, keys, batch_size)), batch_size):
+        deleted += redis.delete(*batch)
+    return deleted
+
+
+def rebuild_flag_index(redis, keys, batch_size=DEFAULT_BATCH_SIZE):
+    user_prefix = keys.user("")
+    flag_keys = [k for k in redis.scan_iter(match=keys.user_flags("*"),
+                                            count=batch_size)]
+    pipe = redis.pipeline(transaction=False)
+    for key in redis.scan_iter(match=keys.flag_users("*"), count=batch_size):
+        pipe.delete(key)
+    pipe.execute()
+    indexed = 0
+    for batch in batches(flag_keys, batch_size):
+        pipe = redis.pipeline(transaction=False)
+        for key in batch:
+            pipe.smembers(key)
+        flag_sets = pipe.execute()
+        pipe = redis.pipeline(transaction=False)
+        for (key, flags) in zip(batch, flag_sets):
+            # <prefix>:user:<id>:flags
+            user_id = key[len(user_prefix):].split(keys.SEPARATOR)[0]
+            for flag in flags:
+                pipe.sadd(keys.flag_users(flag), user_id)
+                indexed += 1
+        pipe.execute()
+    return indexed
+
+
+def parse_cli_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", dest="config", required=True,
+                        help="Configuration File to use")
+    parser.add_argument("-b", "--bot", dest="bot", required=True,
+                        help="Bot name from configuration file to use")
+    parser.add_argument("--batch-size", dest="batch_size", type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help="Number of keys per pipelined batch")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true",
+                        help="Only report what migrate would move")
+    parser.add_argument("command", choices=["migrate", "export", "delete", "reindex"])
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    if args.bot not in config.sections():
+        raise RuntimeError("Bot {0} not in config file!".format(args.bot))
+    return (args, config[args.bot])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    try:
+        (args, config) = parse_cli_arguments()
+        store = NPTelegramBot.create_store(config)
+        keys = RedisKeySchema(config.get("redis_key_prefix", config.name))
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+
+    if args.command == "migrate":
+        result = migrate_legacy_keys(store, keys, args.batch_size,
+                                     args.dry_run)
+        print("{0} {1} keys into prefix {2}, skipped {3} unknown keys.".format("Would move" if args.dry_run else "Moved",
+                                                                               result["moved"],
+                                                                               keys.prefix,
+                                                                               result["skipped"]))
+        for key in result["conflicts"]:
+            print("Not moved, target already exists: {0}".format(key))
+        if not args.dry_run:
+            print("Indexed {0} user flags.".format(rebuild_flag_index(store, keys, args.batch_size)))
+    elif args.command == "export":
+        json.dump(export_keys(store, keys, args.batch_size), sys.stdout,
+                  indent=2, sort_keys=True)
+    elif args.command == "delete":
+        print("Deleted {0} keys with prefix {1}.".format(delete_keys(store, keys, args.batch_size),
+                                                         keys.prefix))
+    elif args.command == "reindex":
+        print("Indexed {0} user flags.".format(rebuild_flag_index(store, keys, args.batch_size)))
+
+
+if __name__ == "__main__":
+    main()
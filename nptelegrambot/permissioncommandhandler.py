@@ -23,4 +23,8 @@ class PermissionCommandHandler(CommandHandler):
     def handle_update(self, update, dispatcher):
         if not self.run_checks(update, dispatcher):
             return
+        # Plain dispatchers don't carry an activity tracker
+        analytics = getattr(dispatcher, "analytics", None)
+        if analytics is not None:
+            analytics.record_command(self.command)
         super().handle_update(update, dispatcher)
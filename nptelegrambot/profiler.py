@@ -0,0 +1,92 @@
+from collections import Counter
+from threading import Lock
+import os
+import sys
+import time
+
+
+class ProfileResult(object):
+    def __init__(self, stacks, samples, duration):
+        # Counter of collapsed stack string -> number of samples
+        self.stacks = stacks
+        self.samples = samples
+        self.duration = duration
+
+    def collapsed(self):
+        # Brendan Gregg's collapsed stack format, one "frame;frame;frame
+        # count" line per stack. Feed it to flamegraph.pl or speedscope.
+        return "\n".join("{0} {1}".format(stack, count)
+                         for (stack, count) in self.stacks.most_common()) + "\n"
+
+    def top_functions(self, count=10):
+        # Self time is the leaf frame, inclusive time is any frame in the
+        # stack (counted once per sample).
+        self_time = Counter()
+        inclusive = Counter()
+        for (stack, samples) in self.stacks.items():
+            frames = stack.split(";")
+            self_time[frames[-1]] += samples
+            for frame in set(frames):
+                inclusive[frame] += samples
+        return (self_time.most_common(count), inclusive.most_common(count))
+
+    def summary(self, count=10):
+        if self.samples == 0:
+            return "No samples taken in {0:.1f}s, dispatcher threads were never seen.".format(self.duration)
+        (self_time, inclusive) = self.top_functions(count)
+        msg = "{0} stack samples over {1:.1f}s\n\nTop self time:\n".format(self.samples,
+                                                                         self.duration)
+        for (frame, samples) in self_time:
+            msg += "{0:5.1f}% {1}\n".format(100.0 * samples / self.samples, frame)
+        msg += "\nTop inclusive time:\n"
+        for (frame, samples) in inclusive:
+            msg += "{0:5.1f}% {1}\n".format(100.0 * samples / self.samples, frame)
+        return msg
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # Only one profile at a time, two samplers would just slow each other
+        # down and skew the results.
+        self.lock = Lock()
+
+    @staticmethod
+    def collapse(frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append("{0} ({1})".format(code.co_name,
+                                             os.path.basename(code.co_filename)))
+            frame = frame.f_back
+        frames.reverse()
+        return ";".join(frames)
+
+    def is_running(self):
+        return self.lock.locked()
+
+    # thread_ids is a callable returning the ids of threads to sample, so
+    # threads that start during the profile get picked up too. Returns None
+    # if a profile is already running.
+    def profile(self, seconds, thread_ids):
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = Counter()
+            samples = 0
+            start = time.monotonic()
+            end = start + seconds
+            while time.monotonic() < end:
+                frames = sys._current_frames()
+                for thread_id in thread_ids():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stacks[self.collapse(frame)] += 1
+                    samples += 1
+                # Drop our reference to every thread's stack before sleeping
+                del frames
+                time.sleep(self.interval)
+            return ProfileResult(stacks, samples, time.monotonic() - start)
+        finally:
+            self.lock.release()
@@ -0,0 +1,160 @@
+from redis.exceptions import RedisError
+from collections import deque
+from contextlib import contextmanager
+import threading
+import logging
+import time
+
+
+# Sends reads to redis replicas and writes to the primary.
+#
+# A thread that just wrote is pinned to the primary for pin_seconds, so
+# handlers and conversations (which run on the dispatcher threads) read their
+# own writes. Code that needs its reads to stay consistent for longer, like
+# a conversation reading back what an earlier step wrote, or a worker thread
+# acting for a pinned thread, runs inside pinned(). Replicas are checked every
+# check_interval seconds and skipped
+# while their link to the primary is down or they're more than max_lag seconds
+# behind, and a replica that errors out is skipped for retry_after seconds,
+# with the read retried on the primary.
+#
+# Lag is measured in replication offsets: each check samples the primary's
+# offset, and a replica is current enough once it has replicated up to where
+# the primary was max_lag seconds ago. Without a recent enough sample of
+# that, replicas have to have caught up with the primary's current offset.
+class RedisRouter(object):
+    def __init__(self, primary, replicas=None, max_lag=5, pin_seconds=None,
+                 check_interval=5, retry_after=30):
+        self.logger = logging.getLogger(__name__)
+        self.primary = primary
+        self.replicas = replicas or []
+        self.max_lag = max_lag
+        # The sample a check goes by can be up to check_interval older than
+        # max_lag, and the check itself up to check_interval old. Past that,
+        # any replica we'd use has the write.
+        if pin_seconds is None:
+            pin_seconds = max_lag + 2 * check_interval
+        self.pin_seconds = pin_seconds
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.healthy = []
+        # (time, primary replication offset), oldest first
+        self.offsets = deque()
+        self.down_until = {}
+        self.last_check = 0
+        self.next_replica = 0
+
+    def pin(self):
+        self.local.pinned_until = time.monotonic() + self.pin_seconds
+
+    # When this thread's reads can go back to replicas
+    def pinned_until(self):
+        return max(getattr(self.local, "pinned_until", 0),
+                   getattr(self.local, "held_until", 0))
+
+    def is_pinned(self):
+        return self.pinned_until() > time.monotonic()
+
+    # Keeps this thread's reads on the primary until the given time (for the
+    # whole block by default), then puts back whatever held it before.
+    @contextmanager
+    def pinned(self, until=float("inf")):
+        previous = getattr(self.local, "held_until", 0)
+        self.local.held_until = max(previous, until)
+        try:
+            yield
+        finally:
+            self.local.held_until = previous
+
+    def writer(self):
+        self.pin()
+        return self.primary
+
+    # The primary's offset max_lag seconds ago, from the newest sample taken
+    # between max_lag and max_lag + check_interval seconds ago. Reads only
+    # trigger checks, so after a quiet spell there may be no such sample, and
+    # then it's the primary's current offset.
+    def required_offset(self, now):
+        primary_offset = self.primary.info("replication")["master_repl_offset"]
+        self.offsets.append((now, primary_offset))
+        cutoff = now - self.max_lag
+        while self.offsets[0][0] < cutoff - self.check_interval:
+            self.offsets.popleft()
+        required = primary_offset
+        for (sampled, offset) in self.offsets:
+            if sampled > cutoff:
+                break
+            required = offset
+        return required
+
+    def replica_ok(self, replica, required_offset):
+        info = replica.info("replication")
+        if info.get("master_link_status") != "up":
+            return False
+        return info.get("slave_repl_offset", -1) >= required_offset
+
+    def check_replicas(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_check < self.check_interval:
+                return
+            # Claim this check so other threads keep using the old list
+            # instead of all checking at once.
+            self.last_check = now
+        try:
+            required_offset = self.required_offset(now)
+        except RedisError as e:
+            self.logger.warning("Could not read the redis primary's replication offset: %s", e)
+            self.healthy = []
+            return
+        healthy = []
+        for replica in self.replicas:
+            if self.down_until.get(id(replica), 0) > now:
+                continue
+            try:
+                if self.replica_ok(replica, required_offset):
+                    healthy.append(replica)
+            except RedisError as e:
+                self.mark_down(replica, e)
+        self.healthy = healthy
+
+    def mark_down(self, replica, error):
+        self.logger.warning("Redis replica %s failed, using primary for %d seconds: %s",
+                            replica, self.retry_after, error)
+        self.down_until[id(replica)] = time.monotonic() + self.retry_after
+        self.healthy = [r for r in self.healthy if r is not replica]
+
+    def reader(self):
+        if not self.replicas or self.is_pinned():
+            return self.primary
+        self.check_replicas()
+        healthy = self.healthy
+        if not healthy:
+            return self.primary
+        self.next_replica = (self.next_replica + 1) % len(healthy)
+        return healthy[self.next_replica]
+
+    def read(self, command, *args, **kwargs):
+        client = self.reader()
+        if client is not self.primary:
+            try:
+                return getattr(client, command)(*args, **kwargs)
+            except RedisError as e:
+                self.mark_down(client, e)
+        return getattr(self.primary, command)(*args, **kwargs)
+
+    # build is called with a pipeline to queue the reads on.
+    def read_pipeline(self, build):
+        client = self.reader()
+        if client is not self.primary:
+            try:
+                pipe = client.pipeline()
+                build(pipe)
+                return pipe.execute()
+            except RedisError as e:
+                self.mark_down(client, e)
+        pipe = self.primary.pipeline()
+        build(pipe)
+        return pipe.execute()
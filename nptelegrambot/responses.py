@@ -0,0 +1,44 @@
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardHide, KeyboardButton
+from collections import OrderedDict
+from threading import Lock
+
+# Pre-serialized keyboard removal. The bot passes JSON strings for
+# reply_markup straight through, so this only gets encoded once.
+HIDE_KEYBOARD = ReplyKeyboardHide().to_json()
+
+
+class ResponseCache(object):
+    def __init__(self, max_keyboards=256):
+        # Static message texts, rendered once at startup
+        self.messages = {}
+        # Sorted button labels -> serialized keyboard, least recently used
+        # first
+        self.keyboards = OrderedDict()
+        self.max_keyboards = max_keyboards
+        self.lock = Lock()
+
+    def add_message(self, name, text):
+        if type(text) is list:
+            text = "\n".join(text)
+        self.messages[name] = text
+
+    def message(self, name):
+        return self.messages[name]
+
+    # Returns the serialized one-row, one-time keyboard for a set of button
+    # labels, like the flag pickers use. Labels are sorted, so the same set
+    # always gives the same keyboard.
+    def keyboard(self, labels):
+        key = tuple(sorted(labels))
+        with self.lock:
+            if key in self.keyboards:
+                self.keyboards.move_to_end(key)
+                return self.keyboards[key]
+        keyboard = ReplyKeyboardMarkup([[KeyboardButton(l) for l in key]],
+                                       one_time_keyboard=True,
+                                       resize_keyboard=True).to_json()
+        with self.lock:
+            self.keyboards[key] = keyboard
+            while len(self.keyboards) > self.max_keyboards:
+                self.keyboards.popitem(last=False)
+        return keyboard
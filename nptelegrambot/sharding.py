@@ -0,0 +1,339 @@
+# Distributed dispatch. The webhook front end publishes raw update JSON to one
+# of shard_count redis streams, picked by chat id so every update for a chat
+# lands on the same stream in order. Workers share the shards between them
+# with a consistent hash ring over the live workers, and read their shards
+# through a consumer group, acknowledging each update only after it's been
+# processed.
+from .base import NPModuleBase
+from redis.exceptions import ResponseError
+from threading import Event
+from bisect import bisect
+import hashlib
+import socket
+import json
+import time
+import zlib
+import os
+
+CONSUMER_GROUP = "dispatchers"
+
+
+def shard_for_chat(chat_id, shard_count):
+    # crc32 rather than hash(), which is randomized per process
+    return zlib.crc32(str(chat_id).encode("utf-8")) % shard_count
+
+
+def update_routing_id(data):
+    # Chat id for anything that happens in a chat, otherwise the sending
+    # user, so a user's inline queries stay ordered too.
+    for field in ["message", "edited_message", "channel_post",
+                  "edited_channel_post"]:
+        if field in data:
+            return data[field]["chat"]["id"]
+    if "callback_query" in data:
+        query = data["callback_query"]
+        if "message" in query:
+            return query["message"]["chat"]["id"]
+        return query["from"]["id"]
+    for field in ["inline_query", "chosen_inline_result"]:
+        if field in data:
+            return data[field]["from"]["id"]
+    return data.get("update_id", 0)
+
+
+class HashRing(object):
+    def __init__(self, nodes, replicas=64):
+        # Each node gets several points on the ring so shards spread evenly
+        # and only about 1/n of them move when a node joins or leaves.
+        self.ring = sorted((self.hash("{0}#{1}".format(node, i)), node)
+                           for node in nodes
+                           for i in range(replicas))
+        self.points = [p for (p, _) in self.ring]
+
+    @staticmethod
+    def hash(value):
+        return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+    def node_for(self, key):
+        if not self.ring:
+            return None
+        index = bisect(self.points, self.hash(str(key))) % len(self.ring)
+        return self.ring[index][1]
+
+
+def next_stream_id(entry_id):
+    (ms, _, seq) = entry_id.partition("-")
+    return "{0}-{1}".format(ms, int(seq or 0) + 1)
+
+
+# Streams aren't capped when publishing, that would drop updates nobody has
+# handled yet. Shard workers trim the updates they've acknowledged instead.
+class UpdatePublisher(object):
+    def __init__(self, store, keys, shard_count):
+        self.store = store
+        self.keys = keys
+        self.shard_count = shard_count
+
+    def publish(self, data):
+        shard = shard_for_chat(update_routing_id(data), self.shard_count)
+        self.store.xadd(self.keys.update_stream(shard),
+                        {"update": json.dumps(data)})
+        return shard
+
+
+# Only renews the lease if this worker still holds it
+RENEW_LEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Only releases the lease if this worker still holds it
+RELEASE_LEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+# Workers see membership changes at their own heartbeats, so for a moment two
+# of them can both think they own a shard. Each shard therefore has a lease
+# key, taken with SET NX PX and renewed by its owner, and a worker only reads
+# and handles a shard's updates while it holds the lease. A worker taking
+# over a shard first claims everything the previous owner left unacknowledged
+# and handles that before reading new updates. Handling is still at least
+# once: an update that was being processed when its lease ran out is handled
+# again by the new owner.
+class ShardWorker(NPModuleBase):
+    def __init__(self, store, keys, shard_count, process_update,
+                 worker_id=None, heartbeat_interval=5, worker_timeout=15,
+                 batch_size=10, block=1, errors=None):
+        super().__init__(__name__, errors)
+        self.store = store
+        self.keys = keys
+        self.shard_count = shard_count
+        # Callable taking the decoded update JSON
+        self.process_update = process_update
+        self.worker_id = worker_id or "{0}:{1}".format(socket.gethostname(),
+                                                       os.getpid())
+        self.heartbeat_interval = heartbeat_interval
+        # A worker that hasn't heartbeat in this long is dropped, and its
+        # shard leases run out after the same time.
+        self.worker_timeout = worker_timeout
+        self.batch_size = batch_size
+        self.block = block
+        self.renew_lease = store.register_script(RENEW_LEASE)
+        self.release_lease = store.register_script(RELEASE_LEASE)
+        self.stop_event = Event()
+        # Shards the hash ring gives this worker
+        self.shards = []
+        # Shards this worker holds the lease for -> when the lease runs out
+        # (monotonic). Only these are read.
+        self.leases = {}
+        self.workers = []
+        self.groups = set()
+        self.last_heartbeat = 0
+        self.read_own_pending = True
+
+    def heartbeat(self):
+        now = time.time()
+        pipe = self.store.pipeline()
+        pipe.zadd(self.keys.shard_workers(), {self.worker_id: now})
+        pipe.zremrangebyscore(self.keys.shard_workers(), "-inf",
+                              now - self.worker_timeout)
+        pipe.zrange(self.keys.shard_workers(), 0, -1)
+        # zrange orders by heartbeat time, which changes every heartbeat
+        workers = sorted(pipe.execute()[2])
+        self.last_heartbeat = now
+        if workers != self.workers:
+            self.rebalance(workers)
+        self.update_leases()
+
+    def rebalance(self, workers):
+        ring = HashRing(workers)
+        shards = [s for s in range(self.shard_count)
+                  if ring.node_for(s) == self.worker_id]
+        self.logger.info("Worker %s now owns %d of %d shards (%d workers)",
+                         self.worker_id, len(shards), self.shard_count,
+                         len(workers))
+        self.workers = workers
+        self.shards = shards
+        for shard in shards:
+            self.ensure_group(shard)
+        self.read_own_pending = True
+
+    def ensure_group(self, shard):
+        if shard in self.groups:
+            return
+        try:
+            self.store.xgroup_create(self.keys.update_stream(shard),
+                                     CONSUMER_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self.groups.add(shard)
+
+    # Gives up leases on shards that moved away, renews the rest, and tries
+    # to take the leases of newly owned shards. A shard whose previous owner
+    # hasn't let go yet is retried at the next heartbeat.
+    def update_leases(self):
+        for shard in list(self.leases):
+            if shard not in self.shards:
+                self.release_lease(keys=[self.keys.shard_lease(shard)],
+                                   args=[self.worker_id])
+                del self.leases[shard]
+            elif self.hold_lease(shard, renew=True):
+                # A read the previous owner had blocked when its lease ran
+                # out can still leave updates with it.
+                self.take_over(shard)
+                self.trim_acknowledged(shard)
+        for shard in self.shards:
+            if shard in self.leases:
+                continue
+            lease_ms = self.worker_timeout * 1000
+            started = time.monotonic()
+            if self.store.set(self.keys.shard_lease(shard), self.worker_id,
+                              nx=True, px=lease_ms):
+                self.leases[shard] = started + self.worker_timeout
+                self.take_over(shard)
+                # Including whatever this worker id left pending last time
+                # it had the shard
+                self.read_own_pending = True
+
+    # Checks the lease before handling an update, renewing it once it's half
+    # used up so a long batch doesn't outlive it.
+    def hold_lease(self, shard, renew=False):
+        expires = self.leases.get(shard)
+        if expires is None:
+            return False
+        started = time.monotonic()
+        if not renew and expires - started > self.worker_timeout / 2.0:
+            return True
+        if self.renew_lease(keys=[self.keys.shard_lease(shard)],
+                            args=[self.worker_id, self.worker_timeout * 1000]):
+            self.leases[shard] = started + self.worker_timeout
+            return True
+        self.logger.warning("Worker %s lost the lease on shard %d",
+                            self.worker_id, shard)
+        del self.leases[shard]
+        return False
+
+    # Moves every update other consumers left unacknowledged on the shard to
+    # this worker, so it's handled (in order, by reading from "0") before
+    # anything new.
+    def take_over(self, shard):
+        stream = self.keys.update_stream(shard)
+        claimed = 0
+        for consumer in self.store.xinfo_consumers(stream, CONSUMER_GROUP):
+            if consumer["name"] == self.worker_id:
+                continue
+            while consumer["pending"]:
+                pending = self.store.xpending_range(stream, CONSUMER_GROUP,
+                                                    min="-", max="+",
+                                                    count=self.batch_size * 10,
+                                                    consumername=consumer["name"])
+                if not pending:
+                    break
+                self.store.xclaim(stream, CONSUMER_GROUP, self.worker_id, 0,
+                                  [p["message_id"] for p in pending],
+                                  justid=True)
+                claimed += len(pending)
+            # Consumers are named after host and pid, so every restart leaves
+            # one behind. Remove it once it's left the worker set and hasn't
+            # read in a while, a worker that's still around could have a read
+            # in flight whose updates would go with it.
+            if (consumer["name"] not in self.workers and
+                    consumer["idle"] >= self.worker_timeout * 1000):
+                self.store.xgroup_delconsumer(stream, CONSUMER_GROUP,
+                                              consumer["name"])
+        if claimed:
+            self.logger.info("Claimed %d pending updates on shard %d",
+                             claimed, shard)
+            self.read_own_pending = True
+
+    # Drops the updates before the oldest unacknowledged one, or everything
+    # delivered so far if nothing is pending. Updates nobody has read yet
+    # always stay. Needs redis 6.2 for XTRIM MINID.
+    def trim_acknowledged(self, shard):
+        stream = self.keys.update_stream(shard)
+        pending = self.store.xpending(stream, CONSUMER_GROUP)
+        if pending["pending"]:
+            min_id = pending["min"]
+        else:
+            groups = self.store.xinfo_groups(stream)
+            delivered = [g["last-delivered-id"] for g in groups
+                         if g["name"] == CONSUMER_GROUP]
+            if not delivered or delivered[0] == "0-0":
+                return
+            min_id = next_stream_id(delivered[0])
+        self.store.xtrim(stream, minid=min_id, approximate=True)
+
+    def handle_entries(self, shard, entries):
+        stream = self.keys.update_stream(shard)
+        for (entry_id, fields) in entries:
+            # Leave the rest pending for whoever holds the lease now
+            if not self.hold_lease(shard):
+                return
+            # Entries can come back empty if they were trimmed from the
+            # stream while pending.
+            if fields:
+                try:
+                    self.process_update(json.loads(fields["update"]))
+                except Exception as e:
+                    # Acknowledge anyway, redelivering an update that always
+                    # fails would wedge the shard.
+                    self.report_error(e, "update {0} on {1}".format(entry_id,
+                                                                    stream))
+            self.store.xack(stream, CONSUMER_GROUP, entry_id)
+
+    def poll(self):
+        if not self.leases:
+            self.stop_event.wait(self.block)
+            return
+        # After a rebalance, a takeover or a restart under the same worker
+        # id, retry our own unacknowledged entries before reading new ones
+        # (">" only returns new entries). Reading from "0" returns one batch
+        # at a time, so keep at it until there's nothing left. Handled
+        # entries are acknowledged, so each read picks up where the last one
+        # stopped.
+        if self.read_own_pending:
+            start_id = "0"
+            block = None
+        else:
+            start_id = ">"
+            block = self.block * 1000
+        shards = dict((self.keys.update_stream(s), s) for s in self.leases)
+        streams = dict((stream, start_id) for stream in shards)
+        results = self.store.xreadgroup(CONSUMER_GROUP, self.worker_id,
+                                        streams, count=self.batch_size,
+                                        block=block)
+        if start_id == "0" and not any(entries for (_, entries) in results or []):
+            self.read_own_pending = False
+        for (stream, entries) in results or []:
+            self.handle_entries(shards[stream], entries)
+
+    def run(self):
+        self.logger.info("Starting shard worker %s", self.worker_id)
+        while not self.stop_event.is_set():
+            try:
+                if time.time() - self.last_heartbeat >= self.heartbeat_interval:
+                    self.heartbeat()
+                self.poll()
+            except Exception as e:
+                self.report_error(e, "shard worker {0}".format(self.worker_id))
+                self.stop_event.wait(self.heartbeat_interval)
+        try:
+            # Leave right away instead of waiting to time out, so the
+            # remaining workers rebalance immediately.
+            self.store.zrem(self.keys.shard_workers(), self.worker_id)
+            for shard in list(self.leases):
+                self.release_lease(keys=[self.keys.shard_lease(shard)],
+                                   args=[self.worker_id])
+            self.leases = {}
+        except Exception as e:
+            self.logger.warning("Could not deregister worker: %s", e)
+
+    def stop(self):
+        self.stop_event.set()
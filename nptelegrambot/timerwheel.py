@@ -0,0 +1,49 @@
+import math
+
+
+# Hashed timer wheel. Scheduling, cancelling and rescheduling a key are O(1),
+# and each tick only looks at the keys in one slot. Timeouts longer than a
+# full turn of the wheel wait out the extra turns in their slot.
+#
+# Not thread safe, callers hold their own lock.
+class TimerWheel(object):
+    def __init__(self, tick, slots=512):
+        self.tick = tick
+        self.wheel = [{} for _ in range(slots)]
+        self.cursor = 0
+        # Key -> slot it's scheduled in
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def schedule(self, key, timeout):
+        self.cancel(key)
+        ticks = max(1, int(math.ceil(timeout / self.tick)))
+        slots = len(self.wheel)
+        slot = (self.cursor + ticks) % slots
+        # Number of times the cursor passes this slot before the key is due
+        self.wheel[slot][key] = (ticks - 1) // slots
+        self.index[key] = slot
+
+    def cancel(self, key):
+        slot = self.index.pop(key, None)
+        if slot is not None:
+            del self.wheel[slot][key]
+
+    # Moves the wheel forward one tick and returns the keys that expired.
+    def advance(self):
+        self.cursor = (self.cursor + 1) % len(self.wheel)
+        bucket = self.wheel[self.cursor]
+        expired = []
+        for (key, rounds) in list(bucket.items()):
+            if rounds == 0:
+                del bucket[key]
+                del self.index[key]
+                expired.append(key)
+            else:
+                bucket[key] = rounds - 1
+        return expired
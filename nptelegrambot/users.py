@@ -1,76 +1,146 @@
 from telegram.ext import CommandHandler
-from telegram import ReplyKeyboardMarkup, KeyboardButton
 from .base import NPModuleBase
+from .responses import ResponseCache
+from .replicas import RedisRouter
+from functools import lru_cache
+from threading import Lock
+
+
+# The same few admins and users get formatted over and over in flag
+# conversations, so keep the formatted names around.
+@lru_cache(maxsize=1024)
+def format_username(firstname, lastname, username):
+    return "{0}{1}{2}".format(firstname + " " if firstname is not None else "",
+                              lastname + " " if lastname is not None else "",
+                              "(@{0})".format(username) if username else "")
 
 
 class UserRedisTransactions(object):
-    def __init__(self, redis):
-        self.redis = redis
+    def __init__(self, redis, keys):
+        # Reads go through the router so they can be served by replicas
+        self.router = redis if isinstance(redis, RedisRouter) else RedisRouter(redis)
+        self.keys = keys
+        self.flags = None
+
+    # Touches redis, so it's run from UserManager.warm_up instead of the
+    # constructor.
+    def ensure_flags(self):
         self.flags = self.get_flags()
         if (self.flags is None or
             "admin" not in self.flags or
-            "block" not in self.flags):
+            "block" not in self.flags or
+            "errors" not in self.flags):
             self.add_flag("admin")
             self.add_flag("block")
+            self.add_flag("errors")
 
     def user_flag_key(self, id):
-        return "{0}:flags".format(id)
+        return self.keys.user_flags(id)
 
     def get_num_users(self):
-        return self.redis.zcard("user-names")
+        return self.router.read("zcard", self.keys.user_names())
+
+    def get_num_flag_users(self, flag):
+        return self.router.read("scard", self.keys.flag_users(flag))
 
     def is_valid_user(self, id):
         return len(self.get_user(id).keys()) > 0
 
     def get_user(self, id):
-        return self.redis.hgetall(id)
+        return self.router.read("hgetall", self.keys.user(id))
 
     def add_flag(self, flag):
-        self.redis.sadd("user-flags", flag)
+        self.router.writer().sadd(self.keys.user_flag_list(), flag)
 
     def remove_flag(self, flag):
-        self.redis.srem("user-flags", flag)
+        self.router.writer().srem(self.keys.user_flag_list(), flag)
 
     def get_flags(self):
-        return self.redis.smembers("user-flags")
+        return self.router.read("smembers", self.keys.user_flag_list())
 
     def add_user_flag(self, id, flag):
-        self.redis.sadd(self.user_flag_key(id), flag)
+        pipe = self.router.writer().pipeline()
+        pipe.sadd(self.user_flag_key(id), flag)
+        pipe.sadd(self.keys.flag_users(flag), id)
+        pipe.execute()
 
     def remove_user_flag(self, id, flag):
-        self.redis.srem(self.user_flag_key(id), flag)
+        pipe = self.router.writer().pipeline()
+        pipe.srem(self.user_flag_key(id), flag)
+        pipe.srem(self.keys.flag_users(flag), id)
+        pipe.execute()
 
     def get_user_flags(self, id):
-        return self.redis.smembers(self.user_flag_key(id))
+        return self.router.read("smembers", self.user_flag_key(id))
+
+    def get_flag_users(self, *flags):
+        return self.router.read("sunion", [self.keys.flag_users(f) for f in flags])
 
     def add_user(self, id, username, firstname, lastname):
-        self.redis.hmset(id, {"username": username,
-                              "firstname": firstname,
-                              "lastname": lastname})
+        self.router.writer().hmset(self.keys.user(id), {"username": username,
+                                                        "firstname": firstname,
+                                                        "lastname": lastname})
 
     def remove_user(self, id):
-        self.redis.delete(id)
-        self.redis.delete("{0}:flags".format(id))
+        pipe = self.router.writer().pipeline()
+        for flag in self.get_user_flags(id):
+            pipe.srem(self.keys.flag_users(flag), id)
+        pipe.delete(self.keys.user(id))
+        pipe.delete(self.user_flag_key(id))
+        pipe.execute()
 
     def get_user_unadded_flags(self, id):
-        return self.redis.sdiff("user-flags", "{0}:flags".format(id))
+        return self.router.read("sdiff",
+                                self.keys.user_flag_list(),
+                                self.user_flag_key(id))
 
     def get_blocked_users(self):
-        return self.redis.smembers("blocked-users")
+        return self.router.read("smembers", self.keys.blocked_users())
 
     def block_user(self, id):
-        self.redis.sadd("blocked-users", id)
+        self.router.writer().sadd(self.keys.blocked_users(), id)
         self.add_user_flag(id, "block")
 
 
 class UserManager(NPModuleBase):
-    def __init__(self, store):
+    def __init__(self, store, keys, responses=None):
         super().__init__(__name__)
-        self.trans = UserRedisTransactions(store)
-        self.has_admin = True
-        self.block_list = self.trans.get_blocked_users()
-        if self.trans.get_num_users() == 0:
-            self.has_admin = False
+        self.trans = UserRedisTransactions(store, keys)
+        self.responses = responses if responses is not None else ResponseCache()
+        # Loaded from redis on first use or by warm_up, whichever comes
+        # first, so building the manager doesn't hit the network.
+        self.warm_lock = Lock()
+        self._has_admin = None
+        self._block_list = None
+
+    def warm_up(self):
+        self.trans.ensure_flags()
+        self.block_list
+        self.has_admin
+
+    @property
+    def has_admin(self):
+        if self._has_admin is None:
+            with self.warm_lock:
+                if self._has_admin is None:
+                    self._has_admin = self.trans.get_num_flag_users("admin") != 0
+        return self._has_admin
+
+    @has_admin.setter
+    def has_admin(self, value):
+        self._has_admin = value
+
+    @property
+    def block_list(self):
+        if self._block_list is None:
+            with self.warm_lock:
+                if self._block_list is None:
+                    self._block_list = self.trans.get_blocked_users()
+        return self._block_list
+
+    @block_list.setter
+    def block_list(self, value):
+        self._block_list = value
 
     def register_with_dispatcher(self, dispatcher):
         dispatcher.add_handler(CommandHandler('register', self.register))
@@ -90,15 +160,19 @@ class UserManager(NPModuleBase):
         if self.trans.is_valid_user(user_id):
             self.logger.debug("User already registered")
             return
+        # Check before adding, has_admin counts users the first time it's read
+        first_user = not self.has_admin
         self.trans.add_user(user_id,
                             user.username,
                             user.first_name,
                             user.last_name)
-        if not self.has_admin:
+        if first_user:
+            self.trans.add_user_flag(user_id, "admin")
+            self.trans.add_user_flag(user_id, "errors")
+            self.has_admin = True
             bot.sendMessage(update.message.chat.id,
                             text="You're the first user, therefore you're the <b>admin</b>.",
                             parse_mode="HTML")
-        self.trans.add_user_flag(user_id, "admin")
 
     def help(self, bot, update):
         return ""
@@ -107,9 +181,9 @@ class UserManager(NPModuleBase):
         return ""
 
     def form_username(self, user):
-        return "{0}{1}{2}".format(user["firstname"] + " " if user["firstname"] is not None else "",
-                                  user["lastname"] + " " if user["lastname"] is not None else "",
-                                  "(@{0})".format(user["username"]) if user["username"] else "")
+        return format_username(user["firstname"],
+                               user["lastname"],
+                               user["username"])
 
     def remove_flag(self, bot, update):
         while True:
@@ -121,33 +195,27 @@ class UserManager(NPModuleBase):
                 user_id = update.message.forward_from.id
                 user = self.trans.get_user(user_id)
                 break
+        username = self.form_username(user)
+        flags = self.trans.get_user_flags(user_id)
         while True:
-            flags = self.trans.get_user_flags(user_id)
-            if not flags or len(flags) is 0:
+            if not flags or len(flags) == 0:
                 bot.sendMessage(update.message.chat.id,
-                                text="User {0} has no flags to remove!".format(self.form_username(user)))
+                                text="User {0} has no flags to remove!".format(username))
                 return
-            buttons = []
-            row = []
-            for f in flags:
-                row.append(KeyboardButton(f))
-            buttons.append(row)
-            keyboard = ReplyKeyboardMarkup(buttons,
-                                           one_time_keyboard=True,
-                                           resize_keyboard=True)
             bot.sendMessage(update.message.chat.id,
-                            text="What is the name of the flag you would like to remove for {0}? If you're done, /cancel".format(self.form_username(user)),
-                            reply_markup=keyboard)
-            # TODO: show permissions flag keyboard here
+                            text="What is the name of the flag you would like to remove for {0}? If you're done, /cancel".format(username),
+                            reply_markup=self.responses.keyboard(flags))
             (bot, update) = yield
             user_flag = update.message.text
             if user_flag not in flags:
-                self.sendMessage(update.message.chat.id,
-                                 text="That's not a valid flag! Try again.")
+                bot.sendMessage(update.message.chat.id,
+                                text="That's not a valid flag! Try again.")
                 continue
             self.trans.remove_user_flag(user_id, user_flag)
+            # Also the flags for the next keyboard
+            flags = self.trans.get_user_flags(user_id)
             bot.sendMessage(update.message.chat.id,
-                            text="Removed flag {0}. {1} now has flags: {2}".format(user_flag, self.form_username(user), self.trans.get_user_flags(user_id)))
+                            text="Removed flag {0}. {1} now has flags: {2}".format(user_flag, username, flags))
 
     def add_flag(self, bot, update):
         while True:
@@ -159,34 +227,25 @@ class UserManager(NPModuleBase):
                 user_id = update.message.forward_from.id
                 user = self.trans.get_user(user_id)
                 break
-        # Build the keyboard
+        username = self.form_username(user)
         while True:
             flags = self.trans.get_user_unadded_flags(user_id)
-            if not flags or len(flags) is 0:
+            if not flags or len(flags) == 0:
                 bot.sendMessage(update.message.chat.id,
-                                text="User {0} has no flags to add!".format(self.form_username(user)))
+                                text="User {0} has no flags to add!".format(username))
                 return
-            buttons = []
-            row = []
-            for f in flags:
-                row.append(KeyboardButton(f))
-            buttons.append(row)
-            keyboard = ReplyKeyboardMarkup(buttons,
-                                           one_time_keyboard=True,
-                                           resize_keyboard=True)
             bot.sendMessage(update.message.chat.id,
-                            text="What is the name of the flag you would like to add for {0}? If you're done, /cancel".format(self.form_username(user)),
-                            reply_markup=keyboard)
-            # TODO: show permissions flag keyboard here
+                            text="What is the name of the flag you would like to add for {0}? If you're done, /cancel".format(username),
+                            reply_markup=self.responses.keyboard(flags))
             (bot, update) = yield
             user_flag = update.message.text
             if user_flag not in flags:
-                self.sendMessage(update.message.chat.id,
-                                 text="That's not a valid flag! Try again.")
+                bot.sendMessage(update.message.chat.id,
+                                text="That's not a valid flag! Try again.")
                 continue
             self.trans.add_user_flag(user_id, user_flag)
             bot.sendMessage(update.message.chat.id,
-                            text="Added flag {0}. {1} now has flags: {2}".format(user_flag, self.form_username(user), self.trans.get_user_flags(user_id)))
+                            text="Added flag {0}. {1} now has flags: {2}".format(user_flag, username, self.trans.get_user_flags(user_id)))
 
     def has_flag(self, user_id, flag):
         user_id = str(user_id)
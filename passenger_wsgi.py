@@ -2,18 +2,34 @@ import sys
 import os
 
 # Make sure we're using the right python. Assume we're running out of the venv.
+# NPBOT_NO_REEXEC skips this, for running under another interpreter (like
+# loadtest.py does).
 INTERP = os.path.join(os.getcwd(), 'bin', 'python')
-if sys.executable != INTERP:
+if sys.executable != INTERP and "NPBOT_NO_REEXEC" not in os.environ:
     os.execl(INTERP, INTERP, *sys.argv)
     sys.path.append(os.getcwd())
 
 import configparser
 import importlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Passenger doesn't set up logging, so without this the bots' startup
+# timings and warnings go nowhere. Goes to stderr, which ends up in the
+# passenger log.
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+startup_start = time.monotonic()
 
 config = configparser.ConfigParser()
-config.read("config.ini")
+config.read(os.environ.get("NPBOT_CONFIG", "config.ini"))
 
-bots = {}
+# Import every bot module first, since that has to happen serially anyway,
+# then build the bots concurrently. Each bot is mostly waiting on telegram
+# while it starts up.
+bot_factories = []
 for bot in config.sections():
     if "disabled" in config[bot] and config[bot]["webhook"] == "1":
         print("Bot {0} disabled".format(bot))
@@ -33,14 +49,26 @@ for bot in config.sections():
         raise RuntimeError("Cannot find module for bot {0}".format(bot))
     module = config[bot]["module_name"]
     importlib.import_module(module)
-    bots[config[bot]["token"]] = getattr(sys.modules[module],
-                                         "create_webhook_bot")(config[bot])
+    bot_factories.append((config[bot],
+                          getattr(sys.modules[module], "create_webhook_bot")))
+import_time = time.monotonic() - startup_start
+
+bots = {}
+if bot_factories:
+    with ThreadPoolExecutor(max_workers=len(bot_factories)) as executor:
+        futures = [(bot_config, executor.submit(factory, bot_config))
+                   for (bot_config, factory) in bot_factories]
+        for (bot_config, future) in futures:
+            # Raises here if the bot failed to start, same as building it
+            # serially would have.
+            bots[bot_config["token"]] = future.result()
+logger.info("Started %d bots in %.3fs (imports %.3fs)", len(bots),
+            time.monotonic() - startup_start, import_time)
 
 if len(bots.keys()) == 0:
     raise RuntimeError("Not running any bots!")
 
-from flask import Flask, request
-import telegram
+from flask import Flask, Response, abort, request
 
 application = Flask(__name__)
 
@@ -52,12 +80,32 @@ def hello():
 
 @application.route('/telegram/<token>', methods=['POST'])
 def webhook(token):
-    update = telegram.update.Update.de_json(request.get_json(force=True))
     if token not in bots.keys():
         return 'OK'
-    bots[token].update_queue.put(update)
+    bots[token].handle_webhook_update(request.get_json(force=True))
     return 'OK'
 
 
+# Profile a bot's dispatcher threads. The bot token in the URL is the only
+# authentication, same as the webhook. Passenger may run this single
+# threaded, so the profile runs in the background and this returns right
+# away. The summary and collapsed stacks for flamegraph.pl are sent to the
+# bot's admins, like /profile does. Only the process that got the request is
+# profiled, its pid is in the response and the file name.
+@application.route('/profile/<token>', methods=['POST'])
+def profile(token):
+    if token not in bots.keys():
+        abort(404)
+    try:
+        seconds = int(request.args.get("seconds", "10"))
+    except ValueError:
+        abort(400)
+    if not bots[token].start_admin_profile(seconds):
+        return Response("A profile is already running!\n", status=409,
+                        mimetype="text/plain")
+    return Response("Profiling process {0}, the result will be sent to the bot's admins.\n".format(os.getpid()),
+                    status=202, mimetype="text/plain")
+
+
 if __name__ == "__main__":
     application.run()